@@ -0,0 +1,27 @@
+"""add comment indexes
+
+Revision ID: 7c1e5a9b2d40
+Revises: 44993a22dac3
+Create Date: 2026-10-16 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c1e5a9b2d40'
+down_revision = '44993a22dac3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # /api/comments の期間指定とキーセットページング（timestamp desc, id desc）用
+    op.create_index('ix_comments_timestamp_id', 'comments', ['timestamp', 'id'])
+    op.create_index('ix_comments_user_id', 'comments', ['user_id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_comments_user_id', table_name='comments')
+    op.drop_index('ix_comments_timestamp_id', table_name='comments')
@@ -0,0 +1,27 @@
+"""add sentiment to comments
+
+Revision ID: b3f8d21c6e57
+Revises: 7c1e5a9b2d40
+Create Date: 2026-10-16 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3f8d21c6e57'
+down_revision = '7c1e5a9b2d40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # 既存の行はNULLのまま追加し、起動時のバックフィル（SentimentAnalyzer.backfill_labels）で分類する
+    op.add_column('comments', sa.Column('sentiment', sa.String(length=16), nullable=True))
+    op.create_index('ix_comments_sentiment', 'comments', ['sentiment'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_comments_sentiment', table_name='comments')
+    op.drop_column('comments', 'sentiment')
@@ -0,0 +1,101 @@
+"""BarSeries（列指向）と従来の DataFrame.iterrows → list of dict の比較ベンチマーク
+
+    python bench_bar_series.py
+
+Yahoo chart APIと同じ形の配列から、キャッシュに載せるまでの時間とメモリ、
+時間範囲での切り出しの時間を計測する。
+"""
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from services.bar_series import BarSeries
+
+
+def make_yahoo_payload(n: int):
+    start = 1700000000
+    timestamps = list(range(start, start + n * 60, 60))
+    close = (20000 + np.cumsum(np.random.normal(0, 5, n))).tolist()
+    quote = {
+        "open": close,
+        "high": [c + 3 for c in close],
+        "low": [c - 3 for c in close],
+        "close": close,
+        "volume": np.random.randint(0, 5000, n).tolist()
+    }
+    # ときどき欠損バーが混ざる
+    for i in range(0, n, 997):
+        quote["close"] = quote["close"][:i] + [None] + quote["close"][i + 1:]
+    return timestamps, quote
+
+
+def iterrows_path(timestamps, quote):
+    """旧実装: DataFrame作成 → dropna → iterrowsでdictのリスト"""
+    df = pd.DataFrame({
+        "timestamp": timestamps,
+        "Open": quote["open"],
+        "High": quote["high"],
+        "Low": quote["low"],
+        "Close": quote["close"],
+        "Volume": quote["volume"]
+    })
+    df["timestamp"] = pd.to_datetime(df["timestamp"], unit="s")
+    df.set_index("timestamp", inplace=True)
+    df = df.dropna()
+    data = []
+    for index, row in df.iterrows():
+        data.append({
+            "time": int(index.timestamp()),
+            "open": float(row["Open"]),
+            "high": float(row["High"]),
+            "low": float(row["Low"]),
+            "close": float(row["Close"]),
+            "volume": int(row["Volume"]) if not pd.isna(row["Volume"]) else 0
+        })
+    return data
+
+
+def timed(func, *args, repeat: int = 3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def retained_bytes(func, *args) -> int:
+    tracemalloc.start()
+    result = func(*args)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main():
+    for n in (2880, 100000):
+        timestamps, quote = make_yahoo_payload(n)
+
+        old_time, records = timed(iterrows_path, timestamps, quote)
+        new_time, series = timed(BarSeries.from_yahoo, timestamps, quote)
+        records_time, _ = timed(series.to_records)
+        print(f"bars={n}")
+        print(f"  build:   iterrows {old_time * 1e3:9.2f} ms | BarSeries.from_yahoo {new_time * 1e3:7.2f} ms "
+              f"(+to_records {records_time * 1e3:.2f} ms)")
+
+        old_bytes = retained_bytes(iterrows_path, timestamps, quote)
+        new_bytes = retained_bytes(BarSeries.from_yahoo, timestamps, quote)
+        print(f"  memory:  list of dict {old_bytes / 1024:9.1f} KiB | BarSeries {new_bytes / 1024:9.1f} KiB")
+
+        lo, hi = timestamps[n // 4], timestamps[n // 2]
+        old_slice, _ = timed(lambda: [r for r in records if lo <= r["time"] <= hi], repeat=5)
+        new_slice, _ = timed(lambda: series.slice_time(lo, hi), repeat=5)
+        print(f"  slice:   list scan {old_slice * 1e6:9.1f} us | searchsorted view {new_slice * 1e6:7.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""ブロードキャスト1回あたりのエンコードコストを計測するマイクロベンチマーク
+
+    python bench_broadcast.py
+
+旧方式（接続ごとに send_json = json.dumps）と、
+新方式（Frame.encode で1回だけエンコードし全接続で共有）を 1k / 10k 接続で比較する。
+"""
+import asyncio
+import json
+import time
+
+from services.connection_manager import ConnectionManager, Frame
+
+MARKET_UPDATE = {
+    "type": "market_update",
+    "data": {
+        "symbol": "NQ=F",
+        "price": 21034.25,
+        "time": 1760000000,
+        "open": 21030.0,
+        "high": 21040.5,
+        "low": 21028.75,
+        "close": 21034.25,
+        "volume": 1523
+    }
+}
+
+NEW_COMMENT = {
+    "type": "new_comment",
+    "data": {
+        "id": 12345,
+        "timestamp": 1760000000,
+        "price": 21034.25,
+        "content": "ここから買い増し、ロングで様子見 🚀",
+        "emotion_icon": "🚀",
+        "user_id": "6f1c2c1e-1f7a-4a53-9a6b-0c1f1b9f0c11"
+    }
+}
+
+
+class FakeWebSocket:
+    async def accept(self):
+        pass
+
+    async def send_text(self, text: str):
+        pass
+
+
+def bench_per_client_json(message: dict, clients: int, rounds: int) -> float:
+    """旧方式: starletteのsend_jsonと同じ json.dumps を接続数ぶん実行"""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for _ in range(clients):
+            json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+    return (time.perf_counter() - start) / rounds
+
+
+def bench_encode_once(message: dict, clients: int, rounds: int) -> float:
+    """新方式: Frameを1回作って全接続のキューに積む"""
+    manager = ConnectionManager(max_queue=rounds + 1)
+
+    async def run():
+        # start前のbroadcastは配送されない（バックエンドが配送先を持たない）
+        await manager.start()
+        for _ in range(clients):
+            await manager.connect(FakeWebSocket())
+        start = time.perf_counter()
+        for _ in range(rounds):
+            await manager.broadcast(message)
+        elapsed = time.perf_counter() - start
+        # 全接続のキューに届いたことを確認する（market_updateは既定のcoalesceで1件にまとまる）
+        if any(not client.queue for client in manager.active_connections.values()):
+            raise RuntimeError("broadcast was not delivered to every connection")
+        for websocket in list(manager.active_connections):
+            manager.disconnect(websocket)
+        await manager.stop()
+        return elapsed / rounds
+
+    return asyncio.run(run())
+
+
+def bench_encode_only(message: dict, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        Frame.encode(message)
+    return (time.perf_counter() - start) / rounds
+
+
+def main():
+    rounds = 20
+    for name, message in (("market_update", MARKET_UPDATE), ("new_comment", NEW_COMMENT)):
+        encode_us = bench_encode_only(message, 10000) * 1e6
+        print(f"[{name}] Frame.encode single: {encode_us:.2f} us")
+        for clients in (1000, 10000):
+            old = bench_per_client_json(message, clients, rounds) * 1e3
+            new = bench_encode_once(message, clients, rounds) * 1e3
+            print(
+                f"[{name}] clients={clients:>6}: per-client json.dumps {old:8.3f} ms/broadcast | "
+                f"encode-once + enqueue {new:8.3f} ms/broadcast ({old / new:.1f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""センチメント集計の比較ベンチマーク（既定は100万コメント）
+
+    python bench_sentiment.py [件数]
+    BENCH_DATABASE_URL=postgresql://... python bench_sentiment.py
+
+旧方式（ORMで全コメントを .all() で読み込み、キーワードを1つずつ in で調べる）と、
+SQL側の集計（保存済みのラベルを SUM(CASE ...) で数える）、メモリ上の件数・累積和を
+全期間と直近1日の範囲で比較する。既定は一時ディレクトリのSQLite。
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+from database import Base
+from models import Comment
+from services.sentiment import SentimentAnalyzer
+
+CONTENTS = [
+    "ここから買い増し、ロングで様子見 🚀",
+    "売り目線。ショートで入ります",
+    "利確しました",
+    "強気継続",
+    "弱気になってきた",
+    "様子見",
+    "上昇トレンド？",
+    "ロングとショートどっちだろう",
+]
+
+
+def populate(session_factory, n: int, analyzer: SentimentAnalyzer):
+    now = datetime.now(timezone.utc)
+    labels = dict(zip(CONTENTS, analyzer.classify_many(CONTENTS)))
+    with session_factory() as db:
+        for offset in range(0, n, 50000):
+            rows = []
+            for _ in range(min(50000, n - offset)):
+                content = random.choice(CONTENTS)
+                rows.append({
+                    "timestamp": now - timedelta(seconds=random.randint(0, 365 * 86400)),
+                    "price": 21000 + random.random() * 100,
+                    "content": content,
+                    "sentiment": labels[content],
+                })
+            db.execute(insert(Comment), rows)
+            db.commit()
+    return now
+
+
+def orm_path(db, *conditions) -> dict:
+    """旧実装: ORMオブジェクトを全件作ってからPythonで分類"""
+    buy_keywords = ["買い", "ロング", "IN", "上昇", "強気", "ブル"]
+    sell_keywords = ["売り", "ショート", "利確", "下落", "弱気", "ベア"]
+    comments = db.query(Comment).filter(*conditions).all()
+    buy_count = sell_count = neutral_count = 0
+    for comment in comments:
+        content = comment.content.lower()
+        has_buy = any(keyword in content for keyword in buy_keywords)
+        has_sell = any(keyword in content for keyword in sell_keywords)
+        if has_buy and not has_sell:
+            buy_count += 1
+        elif has_sell and not has_buy:
+            sell_count += 1
+        else:
+            neutral_count += 1
+    return {"buy": buy_count, "sell": sell_count, "neutral": neutral_count}
+
+
+def timed(func, *args, repeat: int = 3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    url = os.getenv("BENCH_DATABASE_URL")
+    tmpdir = None
+    if not url:
+        tmpdir = tempfile.TemporaryDirectory()
+        url = f"sqlite:///{tmpdir.name}/bench.db"
+    engine = create_engine(url)
+    Base.metadata.drop_all(bind=engine, tables=[Comment.__table__])
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(bind=engine)
+    analyzer = SentimentAnalyzer()
+
+    start = time.perf_counter()
+    now = populate(session_factory, n, analyzer)
+    print(f"comments={n} ({engine.dialect.name}, insert {time.perf_counter() - start:.1f} s)")
+
+    since = now - timedelta(days=1)
+    ranges = {
+        "all time": (),
+        "last 1 day": (Comment.timestamp >= since, Comment.timestamp <= now),
+    }
+    with session_factory() as db:
+        for name, conditions in ranges.items():
+            orm_time, orm_counts = timed(orm_path, db, *conditions, repeat=1)
+            db.expunge_all()
+            sql_time, sql_counts = timed(analyzer._count_labels, db, *conditions)
+            print(f"  {name}:")
+            print(f"    ORM .all() + keyword loop {orm_time * 1e3:10.1f} ms  {orm_counts}")
+            print(f"    SQL SUM(CASE ...)         {sql_time * 1e3:10.1f} ms  {sql_counts}")
+
+        load_time, _ = timed(analyzer.load_counts, db, repeat=1)
+    all_time, _ = timed(analyzer.current, repeat=5)
+    range_time, counts = timed(
+        analyzer.series.range_counts, int(since.timestamp()), int(now.timestamp()), repeat=5
+    )
+    print(f"  in memory (load {load_time:.1f} s): all time {all_time * 1e6:.1f} us | "
+          f"last 1 day {range_time * 1e6:.1f} us {counts}")
+
+    engine.dispose()
+    if tmpdir is not None:
+        tmpdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,19 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends, Request, Response, Body
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine, select
+from fastapi.responses import StreamingResponse
+from sqlalchemy import and_, create_engine, or_, select
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta, timezone
 import json
 import asyncio
-from typing import List, Dict, Optional
+import base64
+from typing import List, Dict, Optional, Tuple
 import os
 from dotenv import load_dotenv
 import logging
 from decimal import Decimal
 import time
+import numpy as np
 from pydantic import BaseModel
 
 # Mock database for testing environment where Postgres is not available
@@ -25,7 +28,8 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-app = FastAPI()
+from services.serialization import FastJSONResponse, dumps
+app = FastAPI(default_response_class=FastJSONResponse)
 
 # Database Setup (Adaptive for Test Environment)
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./test.db")
@@ -72,44 +76,96 @@ app.add_middleware(
     expose_headers=["*"],
 )
 
-# WebSocket接続管理
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-        logger.info(f"WebSocket connected. Total connections: {len(self.active_connections)}")
-
-    def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-        logger.info(f"WebSocket disconnected. Total connections: {len(self.active_connections)}")
-
-    async def broadcast(self, message: dict):
-        disconnected = []
-        for connection in self.active_connections:
-            try:
-                await connection.send_json(message)
-                # 頻繁なログ出力を避けるためデバッグレベルへ
-                # logger.debug(f"Broadcasted message to a connection: {message['type']}")
-            except Exception as e:
-                logger.error(f"Error broadcasting to connection: {e}")
-                disconnected.append(connection)
-        
-        # 切断されたコネクションを削除
-        for conn in disconnected:
-            if conn in self.active_connections:
-                self.active_connections.remove(conn)
-
-manager = ConnectionManager()
-from services.market_data import MarketDataService, RealtimeMarketService
-market_service = MarketDataService()
+# WebSocket接続管理（接続ごとの送信キューでファンアウト）
+from services.connection_manager import ConnectionManager, Frame
+from services.pubsub import create_backend
+# 複数ワーカーで動かす場合は BROADCAST_BACKEND=unix でワーカー間にブロードキャストを中継する
+broadcast_backend = create_backend(
+    os.getenv("BROADCAST_BACKEND", "inprocess"),
+    os.getenv("BROADCAST_SOCKET_PATH", "/tmp/nasdaq100-broadcast.sock")
+)
+from services.market_data import MarketDataService, RealtimeMarketService, canonical_symbol, market_channel
+# コメントはNQ先物のチャートに対するもの
+COMMENTS_CHANNEL = "comments:NQ=F"
+manager = ConnectionManager(
+    max_queue=int(os.getenv("WS_SEND_QUEUE_SIZE", 100)),
+    policy=os.getenv("WS_OVERFLOW_POLICY", "coalesce"),
+    backend=broadcast_backend,
+    # subscribeを送らないクライアントには従来どおりNQ先物の更新とコメントを届ける
+    default_channels=[market_channel(RealtimeMarketService.default_symbol), COMMENTS_CHANNEL],
+    replay_size=int(os.getenv("WS_REPLAY_BUFFER_SIZE", 1000))
+)
+from services.upstream import CircuitBreaker, YahooChartClient
+# Yahooへの接続は両サービスで1つのプールを共有する
+upstream_client = YahooChartClient(
+    timeout=float(os.getenv("UPSTREAM_TIMEOUT", 10)),
+    retries=int(os.getenv("UPSTREAM_RETRIES", 3)),
+    max_clients=int(os.getenv("UPSTREAM_MAX_CONNECTIONS", 10)),
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.getenv("UPSTREAM_FAILURE_THRESHOLD", 5)),
+        reset_timeout=float(os.getenv("UPSTREAM_RESET_TIMEOUT", 30))
+    )
+)
+market_service = MarketDataService(
+    client=upstream_client,
+    max_entries=int(os.getenv("MARKET_CACHE_MAX_ENTRIES", 256)),
+    max_bytes=int(os.getenv("MARKET_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+)
 # リアルタイムサービスを初期化（ブロードキャスト関数を渡す）
-realtime_service = RealtimeMarketService(broadcast_func=manager.broadcast)
+from services.scheduler import PollScheduler
+realtime_service = RealtimeMarketService(
+    broadcast_func=manager.broadcast, client=upstream_client, market_service=market_service,
+    scheduler=PollScheduler(
+        base_interval=float(os.getenv("POLL_BASE_INTERVAL", 2)),
+        min_interval=float(os.getenv("POLL_MIN_INTERVAL", 0.5)),
+        max_interval=float(os.getenv("POLL_MAX_INTERVAL", 15)),
+        closed_interval=float(os.getenv("POLL_CLOSED_INTERVAL", 300))
+    ),
+    client_count=lambda: len(manager.active_connections),
+    max_concurrency=int(os.getenv("REALTIME_MAX_CONCURRENCY", 4)),
+    max_symbols=int(os.getenv("MAX_WATCHED_SYMBOLS", 50))
+)
+# 1接続あたりに見られる銘柄数・購読できるチャンネル数の上限
+MAX_WATCH_PER_CONNECTION = int(os.getenv("MAX_WATCH_PER_CONNECTION", 10))
+MAX_SUBSCRIPTIONS_PER_CONNECTION = int(os.getenv("MAX_SUBSCRIPTIONS_PER_CONNECTION", 32))
+
+
+def parse_channel(channel: str) -> str:
+    """購読できるチャンネル名に正規化する（market:SYMBOL[:INTERVAL] / comments:SYMBOL）。不正ならValueError"""
+    kind, _, rest = channel.partition(":")
+    if kind == "market":
+        symbol, _, interval = rest.partition(":")
+        if interval and interval not in MarketDataService.timeframes:
+            raise ValueError(f"Unknown interval: {interval!r}")
+        return market_channel(canonical_symbol(symbol), interval or None)
+    if kind == "comments":
+        return f"comments:{canonical_symbol(rest)}"
+    raise ValueError(f"Unknown channel: {channel!r}")
+
+# 複数ワーカー時: ロックを取ったワーカーだけがYahooをポーリングし、結果を共有メモリに書く
+from services.shared_state import LeaderLock, SharedMarketState
+shared_state = SharedMarketState(os.getenv("SHARED_STATE_DIR") or None)
+poller_lock = LeaderLock(os.getenv("POLLER_LOCK_PATH", "/tmp/nasdaq100-poller.lock"))
+market_service.shared_state = shared_state
+market_service.is_leader = False
+realtime_service.shared_state = shared_state
+
+# 取得済みのバーをディスクに保存し、再起動後はそこから差分取得を再開する
+from services.bar_store import BarStore
+market_service.bar_store = BarStore(os.getenv("BAR_STORE_DIR", "./data/bars"))
+# 時間足ごとのキャッシュTTLの上書き（例: "1m=60:600,1D=1800:21600"）
+market_service.set_ttls(os.getenv("HISTORICAL_TTL", ""))
+# フォロワーが共有メモリにない履歴をリーダーに頼んで待つ時間（秒）
+market_service.leader_wait = float(os.getenv("HISTORICAL_LEADER_WAIT", 5))
 from services.sentiment import SentimentAnalyzer
+from services.comment_buckets import bucket_comments
 sentiment_analyzer = SentimentAnalyzer()
+# 直近のコメントはメモリに持ち、その範囲の読み取りはDBに行かない
+from services.comment_index import EPOCH, RecentCommentIndex, to_micros
+comment_index = RecentCommentIndex(
+    window=float(os.getenv("COMMENT_INDEX_DAYS", 7)) * 86400,
+    max_entries=int(os.getenv("COMMENT_INDEX_MAX_ENTRIES", 100000))
+)
 from services.auth import AuthService
 auth_service = AuthService()
 
@@ -142,16 +198,55 @@ async def startup_event():
         logger.error(f"Database initialization failed (likely connection issue): {e}")
         # Continue without DB for testing WebSocket
 
+    db = SessionLocal()
+    try:
+        # 分類されていない（列の追加前の）コメントを分類してから件数を読み込む
+        backfilled = sentiment_analyzer.backfill_labels(db)
+        if backfilled:
+            logger.info(f"Backfilled sentiment for {backfilled} comments")
+        sentiment_analyzer.load_counts(db)
+        logger.info(f"Sentiment counts loaded: {sentiment_analyzer.counts}")
+    except Exception as e:
+        logger.error(f"Failed to load sentiment counts: {e}")
+    finally:
+        db.close()
+
+    # 分類を埋めた後に読み込む（索引のコメントにもラベルが付いている状態にする）
+    try:
+        load_comment_index()
+        logger.info(f"Comment index loaded: {len(comment_index)} comments")
+    except Exception as e:
+        logger.error(f"Failed to load comment index: {e}")
+
     logger.info(f"Backend running on port {os.getenv('PORT', 8000)}")
     logger.info("CORS enabled for all origins")
     
+    # 他のワーカーでの投稿・削除もバス経由で索引に反映する
+    manager.add_listener(apply_comment_frame)
+    manager.add_listener(apply_sentiment_frame)
+    await manager.start()
+
+    # ポーリングはリーダーワーカーだけが行い、結果をバスと共有メモリで全ワーカーに配る
+    asyncio.create_task(poller_lock.wait_for_leadership(become_poller_leader))
+
+async def become_poller_leader():
+    logger.info("This worker is the poller leader, starting realtime stream")
+    market_service.is_leader = True
     # リアルタイムストリーミングを開始（バックグラウンドタスク）
     asyncio.create_task(realtime_service.start_stream())
+    # フォロワーが共有メモリになかった履歴を頼んできたら取得して載せる
+    asyncio.create_task(market_service.serve_requests())
+    # 全時間足の履歴を先回りして取得し、フォロワーが共有メモリから読めるようにする
+    asyncio.create_task(market_service.keep_warm("^NDX", ["1m", "3m", "5m", "15m", "1H", "4H", "1D", "1W"]))
 
 @app.on_event("shutdown")
 async def shutdown_event():
     logger.info("Shutting down...")
     realtime_service.stop_stream()
+    shared_state.withdraw_demand()
+    poller_lock.release()
+    await manager.stop()
+    await upstream_client.close()
 
 # Auth Endpoints
 @app.post("/api/auth/gate")
@@ -224,26 +319,108 @@ async def logout(response: Response):
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
+    realtime_service.connections_changed()
     user_id = websocket.cookies.get("user_id")
     
-    # 接続時に最新の価格があれば送信（メモリキャッシュから）
-    if realtime_service.latest_price:
+    # 接続時に最新の価格があれば送信（メモリキャッシュ / 共有メモリから）
+    latest_price = realtime_service.current_snapshot()
+    if latest_price:
         try:
-            await websocket.send_json({
+            await manager.send_personal(websocket, {
                 "type": "market_update",
-                "data": realtime_service.latest_price
+                "channel": market_channel(RealtimeMarketService.default_symbol),
+                "data": latest_price
             })
         except Exception as e:
             logger.error(f"Error sending initial data: {e}")
 
     db: Session = None
+    # この接続が購読しているmarketチャンネルの銘柄と時間足ごとのチャンネル（切断時に需要を戻す）
+    watched = set()
+    watched_channels = set()
+
+    def sync_watched():
+        market = {channel for channel in manager.subscriptions(websocket) if channel.startswith("market:")}
+        symbols = {channel.split(":")[1] for channel in market}
+        for symbol in symbols - watched:
+            realtime_service.watch(symbol)
+        for symbol in watched - symbols:
+            realtime_service.unwatch(symbol)
+        watched.clear()
+        watched.update(symbols)
+        channels = {channel for channel in market if channel.count(":") == 2}
+        for channel in channels - watched_channels:
+            realtime_service.watch_channel(channel)
+        for channel in watched_channels - channels:
+            realtime_service.unwatch_channel(channel)
+        watched_channels.clear()
+        watched_channels.update(channels)
+
+    sync_watched()
     
     try:
         while True:
             data = await websocket.receive_json()
             logger.info(f"Received WebSocket message: {data}")
             
-            if data["type"] == "post_comment":
+            if data["type"] == "resume":
+                # 再接続: 前の接続で最後に受け取ったブロードキャストの続きから送り直す
+                try:
+                    since = int(data.get("since", 0))
+                except (TypeError, ValueError):
+                    await manager.send_personal(websocket, {"type": "error", "message": "since must be an integer"})
+                    continue
+                epoch = data.get("epoch")
+                await manager.resume(websocket, since, str(epoch) if epoch is not None else None)
+
+            elif data["type"] in ("subscribe", "unsubscribe", "watch", "unwatch"):
+                # watch / unwatch は market:SYMBOL の購読の別名
+                if data["type"] in ("subscribe", "unsubscribe"):
+                    requested = str(data.get("channel", ""))
+                else:
+                    requested = market_channel(str(data.get("symbol", "")))
+                try:
+                    channel = parse_channel(requested)
+                except ValueError as e:
+                    await manager.send_personal(websocket, {"type": "error", "message": str(e)})
+                    continue
+
+                if data["type"] in ("unsubscribe", "unwatch"):
+                    manager.unsubscribe(websocket, channel)
+                    sync_watched()
+                    continue
+
+                subscriptions = manager.subscriptions(websocket)
+                if channel not in subscriptions and len(subscriptions) >= MAX_SUBSCRIPTIONS_PER_CONNECTION:
+                    await manager.send_personal(websocket, {
+                        "type": "error",
+                        "message": f"同時に購読できるチャンネルは{MAX_SUBSCRIPTIONS_PER_CONNECTION}件までです"
+                    })
+                    continue
+                kind, symbol, interval = (channel.split(":") + [None])[:3]
+                if kind == "market" and symbol not in watched and len(watched) >= MAX_WATCH_PER_CONNECTION:
+                    await manager.send_personal(websocket, {
+                        "type": "error",
+                        "message": f"同時に見られる銘柄は{MAX_WATCH_PER_CONNECTION}件までです"
+                    })
+                    continue
+                if kind == "market" and symbol not in watched and not realtime_service.can_watch(symbol):
+                    await manager.send_personal(websocket, {
+                        "type": "error",
+                        "message": f"全体で見られる銘柄は{realtime_service.max_symbols}件までです"
+                    })
+                    continue
+
+                manager.subscribe(websocket, channel)
+                sync_watched()
+                if kind == "market":
+                    snapshot = realtime_service.current_snapshot(symbol, interval)
+                    if snapshot:
+                        await manager.send_personal(websocket, {
+                            "type": "market_update", "channel": channel, "data": snapshot
+                        })
+
+            elif data["type"] == "post_comment":
                 # Check Gate Pass (Simplistic check) - ideally validate session/cookie too
                 # For now, we trust the connection if they can post, or we could require auth payload
 
@@ -261,9 +438,11 @@ async def websocket_endpoint(websocket: WebSocket):
                         timestamp = datetime.fromtimestamp(client_timestamp, tz=timezone.utc)
                     else:
                         timestamp = datetime.now(timezone.utc)
+                    # APIは秒単位でしか返さないので秒に揃える（配信したtimestampとDBの値が一致するように）
+                    timestamp = timestamp.replace(microsecond=0)
                     
                     if not content:
-                        await websocket.send_json({
+                        await manager.send_personal(websocket, {
                             "type": "error",
                             "message": "コメント内容が空です"
                         })
@@ -275,7 +454,9 @@ async def websocket_endpoint(websocket: WebSocket):
                         price=Decimal(str(price)),
                         content=content,
                         emotion_icon=emotion_icon,
-                        user_id=user_id
+                        user_id=user_id,
+                        # 分類は投稿時に1度だけ（集計と各ワーカーの件数はこのラベルを使う）
+                        sentiment=sentiment_analyzer.classify(content)
                     )
                     db.add(comment)
                     db.commit()
@@ -292,13 +473,15 @@ async def websocket_endpoint(websocket: WebSocket):
                             "price": float(comment.price),
                             "content": comment.content,
                             "emotion_icon": comment.emotion_icon,
-                            "user_id": comment.user_id
+                            "user_id": comment.user_id,
+                            "sentiment": comment.sentiment
                         }
                     }
                     
-                    await manager.broadcast(broadcast_data)
+                    comment_index.add(to_micros(comment.timestamp), broadcast_data["data"])
+                    await manager.broadcast(broadcast_data, COMMENTS_CHANNEL)
                     
-                    await websocket.send_json({
+                    await manager.send_personal(websocket, {
                         "type": "comment_saved",
                         "data": broadcast_data["data"]
                     })
@@ -307,7 +490,7 @@ async def websocket_endpoint(websocket: WebSocket):
                     logger.error(f"Error saving comment: {e}", exc_info=True)
                     if db:
                         db.rollback()
-                    await websocket.send_json({
+                    await manager.send_personal(websocket, {
                         "type": "error",
                         "message": f"コメントの保存に失敗しました: {str(e)}"
                     })
@@ -325,46 +508,295 @@ async def websocket_endpoint(websocket: WebSocket):
     finally:
         if db:
             db.close()
+        for symbol in watched:
+            realtime_service.unwatch(symbol)
+        for channel in watched_channels:
+            realtime_service.unwatch_channel(channel)
+        realtime_service.connections_changed()
 
 @app.get("/api/health")
 async def health_check():
     """ヘルスチェックエンドポイント"""
     return {"status": "healthy", "service": "nasdaq100-tweet-app"}
 
+@app.get("/api/metrics")
+async def get_metrics():
+    """キャッシュのヒット率・追い出し数とYahoo接続の状態"""
+    return {
+        "cache": market_service.cache_stats(),
+        # ポーリングはリーダーワーカーだけが行う
+        "poller": {"leader": market_service.is_leader, **realtime_service.scheduler.metrics()},
+        "upstream": {
+            "circuit": upstream_client.breaker.state,
+            "consecutive_failures": upstream_client.breaker.failures
+        }
+    }
+
+# /api/market のレスポンス形式（format= クエリまたはAcceptヘッダで選択）
+MARKET_FORMAT_MEDIA_TYPES = {
+    "columnar": "application/vnd.nasdaq100.columnar+json",
+    "binary": "application/vnd.nasdaq100.bars",
+}
+
+def negotiate_market_format(request: Request, format: Optional[str]) -> str:
+    if format in ("records", "columnar", "binary"):
+        return format
+    accept = request.headers.get("accept", "")
+    for name, media_type in MARKET_FORMAT_MEDIA_TYPES.items():
+        if media_type in accept:
+            return name
+    if "application/octet-stream" in accept:
+        return "binary"
+    return "records"
+
 @app.get("/api/market/{symbol}/{interval}")
-async def get_market_data(symbol: str, interval: str):
-    """マーケットデータを取得"""
+async def get_market_data(symbol: str, interval: str, request: Request, format: Optional[str] = None):
+    """マーケットデータを取得
+
+    format=records（既定）: バーごとのオブジェクト配列
+    format=columnar: {"time": [...], "open": [...], ...} の列指向JSON
+    format=binary: 型付き配列のバイナリ（BarSeries.to_bytes を参照）
+    """
     try:
         logger.info(f"Fetching market data for {symbol} with interval {interval}")
-        data = market_service.get_historical_data(symbol, interval)
-        return {"success": True, "data": data}
+        series = await market_service.get_historical_data(symbol, interval)
+        response_format = negotiate_market_format(request, format)
+        if response_format == "binary":
+            return Response(content=series.to_bytes(), media_type=MARKET_FORMAT_MEDIA_TYPES["binary"])
+        if response_format == "columnar":
+            return FastJSONResponse(
+                {"success": True, "format": "columnar", "data": series.to_columns()},
+                media_type=MARKET_FORMAT_MEDIA_TYPES["columnar"]
+            )
+        return FastJSONResponse({"success": True, "data": series.to_records()})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error getting market data: {e}")
         return {"success": True, "data": []}
 
+# /api/comments の1ページの件数
+COMMENTS_DEFAULT_LIMIT = 500
+COMMENTS_MAX_LIMIT = 5000
+
+COMMENT_COLUMNS = (
+    Comment.id, Comment.timestamp, Comment.price, Comment.content, Comment.emotion_icon, Comment.user_id,
+    Comment.sentiment
+)
+
+
+def comment_record(row) -> Dict:
+    """APIとブロードキャストで返すコメントの形（タイムスタンプはUNIX秒）"""
+    return {
+        "id": row.id,
+        "timestamp": int(row.timestamp.timestamp()),
+        "price": float(row.price),
+        "content": row.content,
+        "emotion_icon": row.emotion_icon,
+        "user_id": row.user_id,
+        "sentiment": row.sentiment
+    }
+
+
+def load_comment_index():
+    """直近window秒のコメントをDBから索引に読み込む"""
+    since = datetime.now(timezone.utc) - timedelta(seconds=comment_index.window)
+    db = SessionLocal()
+    try:
+        rows = db.execute(select(*COMMENT_COLUMNS).where(Comment.timestamp >= since))
+        comment_index.load((to_micros(row.timestamp), comment_record(row)) for row in rows)
+    finally:
+        db.close()
+
+
+def apply_comment_frame(frame):
+    """配送されたコメントの投稿・削除を索引に反映する（自分のワーカーで反映済みなら何もしない）"""
+    if frame.channel != COMMENTS_CHANNEL or frame.message is None:
+        return
+    data = frame.message.get("data") or {}
+    if frame.type == "new_comment":
+        comment_index.add(int(data["timestamp"]) * 1_000_000, data)
+    elif frame.type == "delete_comment":
+        comment_index.remove(data["id"])
+
+
+async def apply_sentiment_frame(frame):
+    """配送された投稿・削除で全期間の件数を増減し、このワーカーの接続に sentiment_update を送る
+
+    どのワーカーもバスから同じ順序で反映するので、通知は各ワーカーが自分の接続にだけ送る（通し番号なし）。
+    """
+    if frame.channel != COMMENTS_CHANNEL or frame.message is None:
+        return
+    delta = {"new_comment": 1, "delete_comment": -1}.get(frame.type)
+    data = frame.message.get("data") or {}
+    if delta is None or not sentiment_analyzer.apply(data.get("sentiment"), delta, data.get("timestamp")):
+        return
+    await manager.deliver(Frame.encode({
+        "type": "sentiment_update",
+        "data": sentiment_analyzer.current()
+    }, COMMENTS_CHANNEL))
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    return etag in (value.strip() for value in request.headers.get("if-none-match", "").split(","))
+
+
+def encode_comment_cursor(micros: int, comment_id: int) -> str:
+    """次のページの開始位置（最後に返したコメントの timestamp(マイクロ秒) と id）"""
+    return base64.urlsafe_b64encode(f"{micros}:{comment_id}".encode()).decode().rstrip("=")
+
+
+def decode_comment_cursor(cursor: str) -> Tuple[int, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        micros, comment_id = raw.split(":")
+        return int(micros), int(comment_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+
+
+def stream_comments(stmt, limit: int):
+    """コメントをORMオブジェクトを作らずに1行ずつJSONにして流す（limit+1件目があればnext_cursorを付ける）"""
+    db = SessionLocal()
+    try:
+        result = db.execute(stmt.execution_options(yield_per=500))
+        yield '{"comments":['
+        last = None
+        for count, row in enumerate(result):
+            if count == limit:
+                yield '],"next_cursor":%s}' % dumps(encode_comment_cursor(to_micros(last.timestamp), last.id))
+                return
+            yield ("," if count else "") + dumps(comment_record(row))
+            last = row
+        yield '],"next_cursor":null}'
+    finally:
+        db.close()
+
+
 @app.get("/api/comments")
-async def get_comments(hours: int = 24, interval: str = None, db: Session = Depends(get_db)):
-    """コメントを取得（タイムスタンプをUNIXタイムスタンプ（秒）として返す）"""
+async def get_comments(request: Request, start: Optional[int] = None, end: Optional[int] = None,
+                       limit: int = COMMENTS_DEFAULT_LIMIT, cursor: Optional[str] = None,
+                       hours: Optional[int] = None, interval: Optional[str] = None):
+    """コメントを新しい順に取得（タイムスタンプはUNIXタイムスタンプ（秒））
+
+    start / end（UNIX秒）で期間を絞り込む。startがなければ hours、
+    それもなければ interval の時間足の表示期間を使う（どれもなければ全期間）。
+    limit件ずつ返し、続きがあれば next_cursor を cursor に渡して次のページを取得する。
+    期間が直近の索引に収まっていればメモリから返し、ETagが一致すれば304を返す。
+    """
+    now = int(time.time())
+    if start is None and hours is not None:
+        start = now - hours * 3600
+    if start is None and interval in MarketDataService.timeframes:
+        start = now - MarketDataService.period_map[MarketDataService.timeframes[interval][3]]
+    limit = max(1, min(limit, COMMENTS_MAX_LIMIT))
     try:
-        comments = db.query(Comment).order_by(Comment.timestamp.desc()).all()
-        result = {
-            "comments": []
-        }
-        for c in comments:
-            unix_timestamp = int(c.timestamp.timestamp()) if c.timestamp else int(datetime.now(timezone.utc).timestamp())
-            comment_data = {
-                "id": c.id,
-                "timestamp": unix_timestamp,
-                "price": float(c.price),
-                "content": c.content,
-                "emotion_icon": c.emotion_icon,
-                "user_id": c.user_id
-            }
-            result["comments"].append(comment_data)
-        return result
-    except Exception as e:
-        logger.error(f"Error getting comments: {e}", exc_info=True)
-        return {"comments": []}
+        before = decode_comment_cursor(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if start is not None and comment_index.covers(start * 1_000_000):
+        lo, hi = comment_index.bounds(start * 1_000_000, None if end is None else end * 1_000_000, before)
+        # 同じ版の索引で同じ範囲なら内容も同じ
+        etag = f'"comments-{comment_index.revision}-{lo}-{hi}-{limit}"'
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+        first = max(lo, hi - limit)
+        next_cursor = encode_comment_cursor(*comment_index.keys[first]) if hi - lo > limit else None
+        return FastJSONResponse(
+            {"comments": comment_index.comments[first:hi][::-1], "next_cursor": next_cursor},
+            headers={"ETag": etag, "Cache-Control": "no-cache"}
+        )
+
+    # (timestamp, id) の降順でキーセットページング（ix_comments_timestamp_id を使う）
+    stmt = select(*COMMENT_COLUMNS).order_by(Comment.timestamp.desc(), Comment.id.desc()).limit(limit + 1)
+    if start is not None:
+        stmt = stmt.where(Comment.timestamp >= datetime.fromtimestamp(start, tz=timezone.utc))
+    if end is not None:
+        stmt = stmt.where(Comment.timestamp <= datetime.fromtimestamp(end, tz=timezone.utc))
+    if before is not None:
+        cursor_time = EPOCH + timedelta(microseconds=before[0])
+        stmt = stmt.where(or_(
+            Comment.timestamp < cursor_time,
+            and_(Comment.timestamp == cursor_time, Comment.id < before[1])
+        ))
+
+    return StreamingResponse(stream_comments(stmt, limit), media_type="application/json")
+
+async def visible_candles(symbol: str, interval: str, start: Optional[int], end: Optional[int]):
+    """チャートに表示する足のうち start〜end にかかるもの（startがなければ全体）"""
+    try:
+        series = await market_service.get_historical_data(symbol, interval)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if start is not None and len(series):
+        # startを含む足（startより前に始まっている足）から
+        first = max(int(np.searchsorted(series.time, start, side="right")) - 1, 0)
+        start = int(series.time[first])
+    return series.slice_time(start=start, end=end)
+
+@app.get("/api/comments/buckets")
+async def get_comment_buckets(request: Request, interval: str = "1D", symbol: str = "^NDX",
+                              start: Optional[int] = None, end: Optional[int] = None,
+                              db: Session = Depends(get_db)):
+    """コメントをローソク足ごとにまとめて返す（件数・感情アイコン・本文の先頭数件）
+
+    start / end（UNIX秒）がなければチャートに表示している足の範囲全体。
+    """
+    series = await visible_candles(symbol, interval, start, end)
+    if len(series) == 0:
+        return {"success": True, "interval": interval, "buckets": []}
+
+    start_micros = int(series.time[0]) * 1_000_000
+    if comment_index.covers(start_micros):
+        lo, hi = comment_index.bounds(start_micros, None if end is None else end * 1_000_000)
+        # 足の高値（アノテーションの位置）も変わるので最後の足まで含める
+        etag = (f'"buckets-{comment_index.revision}-{lo}-{hi}-{int(series.time[0])}'
+                f'-{int(series.time[-1])}-{float(series.high[-1])}"')
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+        comments = comment_index.comments[lo:hi]
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    else:
+        stmt = select(*COMMENT_COLUMNS).where(
+            Comment.timestamp >= datetime.fromtimestamp(int(series.time[0]), tz=timezone.utc)
+        ).order_by(Comment.timestamp, Comment.id)
+        if end is not None:
+            stmt = stmt.where(Comment.timestamp <= datetime.fromtimestamp(end, tz=timezone.utc))
+        comments = [comment_record(row) for row in db.execute(stmt)]
+        headers = None
+
+    times = np.fromiter((c["timestamp"] for c in comments), dtype=np.int64, count=len(comments))
+    return FastJSONResponse({
+        "success": True,
+        "interval": interval,
+        "buckets": bucket_comments(series, times, comments)
+    }, headers=headers)
+
+@app.get("/api/sentiment/series")
+async def get_sentiment_series(interval: str = "1D", symbol: str = "^NDX",
+                               start: Optional[int] = None, end: Optional[int] = None):
+    """ローソク足ごとの buy / sell / neutral 件数（列形式。time はその足の開始時刻）
+
+    分ごとの件数の累積和から足の区切りで引き算するだけなので、コメント数によらず足の本数分の計算で済む。
+    """
+    if sentiment_analyzer.counts is None:
+        raise HTTPException(status_code=503, detail="Sentiment series is not loaded")
+    series = await visible_candles(symbol, interval, start, end)
+    # 最後の足はendの分まで（endがなければ以降すべて）
+    last_edge = np.iinfo(np.int64).max if end is None else end + sentiment_analyzer.series.resolution
+    # 足ごとの行を列ごとの連続した配列に並べ替える
+    buy, sell, neutral = np.ascontiguousarray(
+        sentiment_analyzer.series.between(np.append(series.time, last_edge)).T
+    )
+    return FastJSONResponse({
+        "success": True,
+        "interval": interval,
+        "time": series.time,
+        "buy": buy,
+        "sell": sell,
+        "neutral": neutral
+    })
 
 @app.get("/api/sentiment")
 async def get_sentiment(
@@ -401,14 +833,17 @@ async def delete_comment(comment_id: int, request: Request, db: Session = Depend
     if comment.user_id != user_id:
         raise HTTPException(status_code=403, detail="Not authorized to delete this comment")
 
+    sentiment = comment.sentiment or sentiment_analyzer.classify(comment.content)
+    comment_timestamp = int(comment.timestamp.timestamp())
     db.delete(comment)
     db.commit()
+    comment_index.remove(comment_id)
 
     # Broadcast deletion
     await manager.broadcast({
         "type": "delete_comment",
-        "data": {"id": comment_id}
-    })
+        "data": {"id": comment_id, "timestamp": comment_timestamp, "sentiment": sentiment}
+    }, COMMENTS_CHANNEL)
 
     return {"success": True}
 
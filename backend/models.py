@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DECIMAL, DateTime, ForeignKey, Boolean, LargeBinary
+from sqlalchemy import Column, Integer, String, Text, DECIMAL, DateTime, ForeignKey, Boolean, LargeBinary, Index
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from database import Base
@@ -11,11 +11,18 @@ class Comment(Base):
     price = Column(DECIMAL(10, 2), nullable=False)
     content = Column(Text, nullable=False)
     emotion_icon = Column(String(255))
-    user_id = Column(String, ForeignKey("users.id"), nullable=True)
+    user_id = Column(String, ForeignKey("users.id"), nullable=True, index=True)
+    # 投稿時に分類した buy / sell / neutral（集計はこの列のGROUP BYで行う）
+    sentiment = Column(String(16), nullable=True, index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     user = relationship("User", backref="comments")
 
+    __table_args__ = (
+        # 期間指定・キーセットページング（timestamp desc, id desc）用
+        Index("ix_comments_timestamp_id", "timestamp", "id"),
+    )
+
 class User(Base):
     __tablename__ = "users"
 
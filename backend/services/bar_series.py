@@ -0,0 +1,142 @@
+import struct
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+COLUMNS = ("time", "open", "high", "low", "close", "volume")
+
+# バイナリ形式: magic(4) + version(u32) + 本数(u32) + 予約(u32) の後に
+# time/open/high/low/close/volume の順でリトルエンディアンfloat64配列が並ぶ
+# （JSから new Float64Array(buffer, 16 + i * 8 * count, count) でそのまま読める）
+BINARY_MAGIC = b"BARS"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<4sIII")
+
+
+class BarSeries:
+    """OHLCVの列指向ストア（time: int64秒, OHLCV: float64）
+
+    スライスはnumpyのビューを返すのでコピーは発生しない。
+    """
+    __slots__ = COLUMNS
+
+    def __init__(self, time: np.ndarray, open: np.ndarray, high: np.ndarray,
+                 low: np.ndarray, close: np.ndarray, volume: np.ndarray):
+        self.time = time
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.volume = volume
+
+    @classmethod
+    def empty(cls) -> "BarSeries":
+        return cls(np.empty(0, dtype=np.int64), *(np.empty(0, dtype=np.float64) for _ in range(5)))
+
+    @classmethod
+    def from_yahoo(cls, timestamps: Sequence, quote: Dict) -> "BarSeries":
+        """Yahoo chart APIの配列から一括で作成（OHLCが欠けたバーは除外）"""
+        n = len(timestamps)
+
+        def column(name: str) -> np.ndarray:
+            values = quote.get(name) or [None] * n
+            # Noneはnanになる
+            return np.array(values, dtype=np.float64)
+
+        time = np.array(timestamps, dtype=np.int64)
+        open_, high, low, close = (column(name) for name in ("open", "high", "low", "close"))
+        volume = column("volume")
+
+        valid = ~(np.isnan(open_) | np.isnan(high) | np.isnan(low) | np.isnan(close))
+        volume = np.nan_to_num(volume, nan=0.0)
+        if valid.all():
+            return cls(time, open_, high, low, close, volume)
+        return cls(time[valid], open_[valid], high[valid], low[valid], close[valid], volume[valid])
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, Sequence]) -> "BarSeries":
+        return cls(
+            np.asarray(columns["time"], dtype=np.int64),
+            *(np.asarray(columns[name], dtype=np.float64) for name in COLUMNS[1:])
+        )
+
+    @classmethod
+    def from_records(cls, records: List[Dict]) -> "BarSeries":
+        return cls.from_columns({name: [r[name] for r in records] for name in COLUMNS})
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in COLUMNS)
+
+    @property
+    def last_time(self) -> Optional[int]:
+        return int(self.time[-1]) if len(self.time) else None
+
+    def last_bar(self) -> Optional[Dict]:
+        """最後のバー（to_recordsと同じ形）"""
+        if len(self) == 0:
+            return None
+        return self._take(slice(-1, None)).to_records()[0]
+
+    def _take(self, index) -> "BarSeries":
+        return BarSeries(*(getattr(self, name)[index] for name in COLUMNS))
+
+    def slice_time(self, start: Optional[int] = None, end: Optional[int] = None) -> "BarSeries":
+        """start <= time <= end のビューを二分探索で返す"""
+        lo = 0 if start is None else int(np.searchsorted(self.time, start, side="left"))
+        hi = len(self.time) if end is None else int(np.searchsorted(self.time, end, side="right"))
+        return self._take(slice(lo, hi))
+
+    def merge(self, newer: "BarSeries") -> "BarSeries":
+        """newerの先頭以降を置き換えた新しい系列（未確定の最後のバーも更新される）"""
+        if len(newer) == 0:
+            return self
+        if len(self) == 0:
+            return newer
+        keep = int(np.searchsorted(self.time, newer.time[0], side="left"))
+        return BarSeries(*(
+            np.concatenate((getattr(self, name)[:keep], getattr(newer, name)))
+            for name in COLUMNS
+        ))
+
+    def resample(self, width: int, offset: int = 0) -> "BarSeries":
+        """width秒ごとの足にまとめる（offsetは区切りの基準時刻）"""
+        if len(self) == 0:
+            return self
+        buckets = (self.time - offset) // width * width + offset
+        # timeは昇順なので、バケットの切れ目が各足の先頭になる
+        starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        ends = np.r_[starts[1:], len(buckets)] - 1
+        return BarSeries(
+            buckets[starts],
+            self.open[starts],
+            np.maximum.reduceat(self.high, starts),
+            np.minimum.reduceat(self.low, starts),
+            self.close[ends],
+            np.add.reduceat(self.volume, starts)
+        )
+
+    def to_columns(self) -> Dict[str, np.ndarray]:
+        """列ごとの配列（volumeは整数にする）"""
+        columns = {name: getattr(self, name) for name in COLUMNS}
+        columns["volume"] = self.volume.astype(np.int64)
+        return columns
+
+    def to_bytes(self) -> bytes:
+        """型付き配列のバイナリ形式に変換"""
+        header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(self), 0)
+        body = np.concatenate([getattr(self, name).astype("<f8") for name in COLUMNS])
+        return header + body.tobytes()
+
+    def to_records(self) -> List[Dict]:
+        """APIの従来形式（バーごとのdict）に変換"""
+        return [
+            {"time": t, "open": o, "high": h, "low": l, "close": c, "volume": int(v)}
+            for t, o, h, l, c, v in zip(
+                self.time.tolist(), self.open.tolist(), self.high.tolist(),
+                self.low.tolist(), self.close.tolist(), self.volume.tolist()
+            )
+        ]
@@ -0,0 +1,114 @@
+import logging
+import os
+import struct
+from typing import Optional
+from urllib.parse import quote
+
+import numpy as np
+
+from services.bar_series import COLUMNS, BarSeries
+
+logger = logging.getLogger(__name__)
+
+# ファイル先頭: magic(4) + version(u32) + 本数(u64) + 最終バー時刻(i64) + symbol(16) + interval(8) + 予約
+HEADER = struct.Struct("<4sIQq16s8s16x")
+MAGIC = b"NQBS"
+VERSION = 1
+# 1バー = time(i64) + OHLCV(f64 x 5) の固定長レコード
+RECORD_DTYPE = np.dtype([("time", "<i8")] + [(name, "<f8") for name in COLUMNS[1:]])
+
+
+class BarStore:
+    """(symbol, 基準時間足) ごとの追記型の固定長バイナリファイル
+
+    ヘッダに本数と最終バー時刻を持つので、再起動後もそこから差分取得を再開できる。
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, symbol: str, interval: str) -> str:
+        # 記号はパーセントエンコードする（^NDX と _NDX、BRK-B と BRK.B が同じファイルにならないように）
+        return os.path.join(self.directory, f"{quote(symbol, safe='')}_{interval}.bars")
+
+    def _read_header(self, f, symbol: str, interval: str) -> Optional[tuple]:
+        """(本数, 最終バー時刻)。形式が違う・別の (symbol, interval) のファイルならNone"""
+        raw = f.read(HEADER.size)
+        if len(raw) < HEADER.size:
+            return None
+        magic, version, count, last_time, stored_symbol, stored_interval = HEADER.unpack(raw)
+        if magic != MAGIC or version != VERSION:
+            return None
+        if (stored_symbol.rstrip(b"\0"), stored_interval.rstrip(b"\0")) != (symbol.encode()[:16], interval.encode()[:8]):
+            logger.warning(f"Bar store {f.name} belongs to {stored_symbol!r} {stored_interval!r}, not {symbol} {interval}")
+            return None
+        return count, last_time
+
+    def last_time(self, symbol: str, interval: str) -> Optional[int]:
+        """保存済みの最終バー時刻（差分取得の開始点）"""
+        try:
+            with open(self._path(symbol, interval), "rb") as f:
+                header = self._read_header(f, symbol, interval)
+        except FileNotFoundError:
+            return None
+        if not header or header[0] == 0:
+            return None
+        return header[1]
+
+    def load(self, symbol: str, interval: str, start: Optional[int] = None) -> BarSeries:
+        """ファイルをmmapして start 以降のバーを読み込む"""
+        path = self._path(symbol, interval)
+        try:
+            with open(path, "rb") as f:
+                header = self._read_header(f, symbol, interval)
+        except FileNotFoundError:
+            return BarSeries.empty()
+        if not header:
+            logger.warning(f"Ignoring bar store with unknown format or owner: {path}")
+            return BarSeries.empty()
+
+        count = header[0]
+        if count == 0:
+            return BarSeries.empty()
+        records = np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=HEADER.size, shape=(count,))
+        lo = 0 if start is None else int(np.searchsorted(records["time"], start, side="left"))
+        # レコードは行形式なので、必要な範囲だけ列ごとの連続した配列にコピーする
+        series = BarSeries(*(np.ascontiguousarray(records[name][lo:]) for name in COLUMNS))
+        del records
+        return series
+
+    def append(self, symbol: str, interval: str, series: BarSeries):
+        """保存済みの最終バー以降を追記する（最終バーと同じ時刻のバーは上書き）"""
+        if len(series) == 0:
+            return
+        path = self._path(symbol, interval)
+        mode = "r+b" if os.path.exists(path) else "w+b"
+        with open(path, mode) as f:
+            header = self._read_header(f, symbol, interval)
+            count, last_time = header if header else (0, None)
+            if count == 0:
+                last_time = None
+
+            if last_time is None:
+                position = 0
+                new = series
+            else:
+                new = series.slice_time(start=last_time)
+                if len(new) == 0:
+                    return
+                # 最終バーはまだ確定していなかった可能性があるので置き換える
+                position = count - 1 if int(new.time[0]) == last_time else count
+
+            records = np.empty(len(new), dtype=RECORD_DTYPE)
+            for name in COLUMNS:
+                records[name] = getattr(new, name)
+
+            # レコードを書いてからヘッダを更新する（途中で落ちても本数が合わないことはない）
+            f.seek(HEADER.size + position * RECORD_DTYPE.itemsize)
+            f.write(records.tobytes())
+            f.seek(0)
+            f.write(HEADER.pack(
+                MAGIC, VERSION, position + len(new), int(new.time[-1]),
+                symbol.encode()[:16], interval.encode()[:8]
+            ))
@@ -0,0 +1,124 @@
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterator, Optional, Tuple
+
+
+def default_sizeof(value: Any) -> int:
+    # BarSeriesやnumpy配列はnbytes、それ以外はオブジェクト自体の大きさ
+    nbytes = getattr(value, "nbytes", None)
+    return nbytes if nbytes is not None else sys.getsizeof(value)
+
+
+class TTLCache:
+    """件数・バイト数に上限のあるLRUキャッシュ（キーごとのTTLとヒット率の計測つき）
+
+    値と一緒に格納時刻を持つので、呼び出し側で「古いが使える」判定（stale-while-revalidate）ができる。
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: Optional[int] = None,
+                 default_ttl: Optional[float] = None, sizeof: Callable[[Any], int] = default_sizeof):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.sizeof = sizeof
+        # key -> (値, 格納時刻, 期限, サイズ)
+        self._entries: "OrderedDict[Hashable, Tuple[Any, float, Optional[float], int]]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self._live(key) is not None
+
+    def __setitem__(self, key: Hashable, value: Any):
+        self.set(key, value)
+
+    def _live(self, key: Hashable):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at = entry[2]
+        if expires_at is not None and time.time() >= expires_at:
+            self._remove(key)
+            self.expirations += 1
+            return None
+        return entry
+
+    def _remove(self, key: Hashable):
+        entry = self._entries.pop(key)
+        self.bytes -= entry[3]
+
+    def get_entry(self, key: Hashable) -> Optional[Tuple[Any, float]]:
+        """(値, 格納時刻) を返す。期限切れ・未登録ならNone"""
+        entry = self._live(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0], entry[1]
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self.get_entry(key)
+        return default if entry is None else entry[0]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None, stored_at: Optional[float] = None):
+        """値を格納する。ttl秒を過ぎると消える（Noneならdefault_ttl、それもNoneなら無期限）"""
+        if key in self._entries:
+            self._remove(key)
+        now = time.time() if stored_at is None else stored_at
+        ttl = self.default_ttl if ttl is None else ttl
+        size = self.sizeof(value)
+        self._entries[key] = (value, now, None if ttl is None else now + ttl, size)
+        self.bytes += size
+        self._evict(keep=key)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        if key not in self._entries:
+            return default
+        value = self._entries[key][0]
+        self._remove(key)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def items(self) -> Iterator[Tuple[Hashable, Tuple[Any, float]]]:
+        """期限内の (キー, (値, 格納時刻))。LRUの順序やカウンタは変えない"""
+        now = time.time()
+        for key, (value, stored_at, expires_at, _) in list(self._entries.items()):
+            if expires_at is None or now < expires_at:
+                yield key, (value, stored_at)
+
+    def _evict(self, keep: Hashable):
+        # 古く使われたものから上限に収まるまで追い出す（今入れたものは残す）
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_entries
+            or (self.max_bytes is not None and self.bytes > self.max_bytes)
+        ):
+            oldest = next(iter(self._entries))
+            if oldest == keep:
+                break
+            self._remove(oldest)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,45 @@
+from collections import Counter
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+from services.bar_series import BarSeries
+
+
+def bucket_comments(series: BarSeries, times: np.ndarray, comments: Sequence[Dict],
+                    max_previews: int = 3, max_icons: int = 3) -> List[Dict]:
+    """コメントをローソク足ごとにまとめる（1本の足につき1件）
+
+    times はコメントのUNIX秒（昇順、commentsと同じ順）。各コメントは開始時刻が
+    それ以下で最も新しい足に入る（最初の足より前のコメントは捨てる）。
+    """
+    if len(series) == 0 or len(times) == 0:
+        return []
+
+    # 足の開始時刻で二分探索して、コメントごとの足の番号をまとめて求める
+    index = np.searchsorted(series.time, times, side="right") - 1
+    first = int(np.searchsorted(index, 0))
+    index = index[first:]
+    if len(index) == 0:
+        return []
+    # timesが昇順なので同じ足のコメントは連続している
+    bars, starts, counts = np.unique(index, return_index=True, return_counts=True)
+
+    buckets = []
+    for bar, start, count in zip(bars.tolist(), starts.tolist(), counts.tolist()):
+        group = comments[first + start:first + start + count]
+        icons = Counter(c["emotion_icon"] or "💬" for c in group)
+        bucket = {
+            "time": int(series.time[bar]),
+            "high": float(series.high[bar]),
+            "count": count,
+            "icons": [[icon, n] for icon, n in icons.most_common(max_icons)],
+            # 新しいものから
+            "previews": [c["content"] for c in group[:-max_previews - 1:-1]],
+            "user_ids": sorted({c["user_id"] for c in group if c["user_id"]}),
+        }
+        if count == 1:
+            # 1件だけなら削除などに使えるようにコメントそのものを付ける
+            bucket["comment"] = group[0]
+        buckets.append(bucket)
+    return buckets
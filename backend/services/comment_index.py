@@ -0,0 +1,103 @@
+import bisect
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def to_micros(timestamp: datetime) -> int:
+    """UNIXマイクロ秒（タイムゾーンなしはUTCとみなす）"""
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    delta = timestamp - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+class RecentCommentIndex:
+    """直近window秒のコメントを (timestamp, id) 順に持つメモリ上の索引
+
+    起動時にDBから読み込み、投稿・削除のたびに更新する（同じidの二重反映は無視する）。
+    horizon以降のコメントはすべて載っているので、その範囲の読み取りはDBに行かずに二分探索で返せる。
+    内容が変わるたびにversionが上がる。versionは再起動で0に戻るので、ETagには起動ごとのIDを付けたrevisionを使う。
+    """
+
+    def __init__(self, window: float = 7 * 86400, max_entries: int = 100_000):
+        self.window = window
+        self.max_entries = max_entries
+        # (timestamp(マイクロ秒), id) の昇順とそれに対応するコメント
+        self.keys: List[Tuple[int, int]] = []
+        self.comments: List[Dict] = []
+        self.by_id: Dict[int, Tuple[int, int]] = {}
+        # このマイクロ秒以降のコメントはすべて載っている（Noneなら未読み込み）
+        self.horizon: Optional[int] = None
+        self.version = 0
+        self.instance_id = uuid.uuid4().hex[:8]
+
+    @property
+    def revision(self) -> str:
+        """ETag用の版（再起動・別ワーカーの索引と重ならない）"""
+        return f"{self.instance_id}.{self.version}"
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def load(self, rows: Iterable[Tuple[int, Dict]], now: Optional[float] = None):
+        """(timestamp(マイクロ秒), コメント) の列で置き換える（rowsはwindow内のすべて）"""
+        entries = sorted(((micros, comment["id"]), comment) for micros, comment in rows)
+        self.keys = [key for key, _ in entries]
+        self.comments = [comment for _, comment in entries]
+        self.by_id = {key[1]: key for key in self.keys}
+        self.horizon = int(((time.time() if now is None else now) - self.window) * 1_000_000)
+        self.version += 1
+        self._prune(now)
+
+    def add(self, micros: int, comment: Dict) -> bool:
+        if self.horizon is None or comment["id"] in self.by_id or micros < self.horizon:
+            return False
+        key = (micros, comment["id"])
+        position = bisect.bisect_left(self.keys, key)
+        self.keys.insert(position, key)
+        self.comments.insert(position, comment)
+        self.by_id[key[1]] = key
+        self.version += 1
+        self._prune()
+        return True
+
+    def remove(self, comment_id: int) -> bool:
+        key = self.by_id.pop(comment_id, None)
+        if key is None:
+            return False
+        position = bisect.bisect_left(self.keys, key)
+        del self.keys[position]
+        del self.comments[position]
+        self.version += 1
+        return True
+
+    def covers(self, start_micros: Optional[int]) -> bool:
+        """start以降のコメントがすべてメモリにあるか"""
+        return self.horizon is not None and start_micros is not None and start_micros >= self.horizon
+
+    def bounds(self, start_micros: int, end_micros: Optional[int] = None,
+               before: Optional[Tuple[int, int]] = None) -> Tuple[int, int]:
+        """start <= timestamp <= end（かつ (timestamp, id) < before）の位置の範囲 [lo, hi)"""
+        lo = bisect.bisect_left(self.keys, (start_micros, -1))
+        hi = len(self.keys) if end_micros is None else bisect.bisect_left(self.keys, (end_micros + 1, -1))
+        if before is not None:
+            hi = min(hi, bisect.bisect_left(self.keys, before))
+        return lo, max(lo, hi)
+
+    def _prune(self, now: Optional[float] = None):
+        # windowより古いもの・件数の上限を超えた古いものを捨てる
+        horizon = int(((time.time() if now is None else now) - self.window) * 1_000_000)
+        cut = bisect.bisect_left(self.keys, (horizon, -1))
+        cut = max(cut, len(self.keys) - self.max_entries)
+        if cut <= 0:
+            return
+        horizon = max(horizon, self.keys[cut - 1][0] + 1)
+        for key in self.keys[:cut]:
+            del self.by_id[key[1]]
+        del self.keys[:cut]
+        del self.comments[:cut]
+        self.horizon = max(self.horizon, horizon)
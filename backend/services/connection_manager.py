@@ -0,0 +1,343 @@
+import asyncio
+import logging
+import bisect
+from collections import deque
+from enum import Enum
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from fastapi import WebSocket
+
+from services.serialization import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+
+class OverflowPolicy(str, Enum):
+    """送信キューが溢れたときの挙動"""
+    DROP_OLDEST = "drop_oldest"  # 最も古いメッセージを捨てる
+    COALESCE = "coalesce"  # 未送信のmarket_updateを最新のもので置き換える
+    DISCONNECT = "disconnect"  # 遅いクライアントを切断する
+
+
+class Frame:
+    """一度だけエンコードした送信フレーム（全接続で共有する）
+
+    channelがNoneのフレームは全接続に、それ以外はそのチャンネルを購読している接続にだけ届く。
+    seqはブロードキャストの通し番号（再接続時の再送に使う。個別送信のフレームはNone）、
+    epochはその番号を振り始めたブローカーの起動ごとのID（再起動で番号が0に戻ったことを見分ける）。
+    """
+    __slots__ = ("type", "text", "message", "channel", "seq", "epoch", "_merged")
+
+    def __init__(self, message_type: Optional[str], text: str, message: Optional[dict] = None,
+                 channel: Optional[str] = None, seq: Optional[int] = None, epoch: Optional[str] = None):
+        self.type = message_type
+        self.text = text
+        self.message = message
+        self.channel = channel
+        self.seq = seq
+        self.epoch = epoch
+        # merge済みのフレーム（id(古いフレーム) -> (古いフレーム, 結果)）
+        self._merged: Optional[Dict[int, Tuple["Frame", "Frame"]]] = None
+
+    @classmethod
+    def encode(cls, message: dict, channel: Optional[str] = None) -> "Frame":
+        return cls(message.get("type"), dumps(message), message, channel, message.get("seq"), message.get("epoch"))
+
+    @classmethod
+    def decode(cls, text: str, channel: Optional[str] = None) -> "Frame":
+        """他プロセスから届いたエンコード済みフレームを復元（再エンコードはしない）"""
+        message = loads(text)
+        return cls(message.get("type"), text, message, channel, message.get("seq"), message.get("epoch"))
+
+    def with_seq(self, seq: int, epoch: str) -> "Frame":
+        """通し番号を付けたフレーム（エンコード済みのJSONの先頭に差し込むだけで再エンコードはしない）"""
+        message = {"seq": seq, "epoch": epoch, **self.message} if self.message is not None else None
+        text = '{"seq":%d,"epoch":"%s",' % (seq, epoch) + self.text[1:]
+        return Frame(self.type, text, message, self.channel, seq, epoch)
+
+    def to_wire(self) -> bytes:
+        """プロセス間バスの1行（"チャンネル\\tJSON\\n"。JSONにタブ文字がそのまま現れることはない）"""
+        return f"{self.channel or ''}\t{self.text}\n".encode("utf-8")
+
+    @classmethod
+    def from_wire(cls, line: bytes) -> "Frame":
+        channel, _, text = line.rstrip(b"\n").decode("utf-8").partition("\t")
+        return cls.decode(text, channel or None)
+
+    def merge(self, newer: "Frame") -> "Frame":
+        """未送信のmarket_update差分に新しい差分を重ねた1フレームを作る
+
+        同じ未送信フレームを持つ接続どうしでは結果を共有する（エンコードは組ごとに1回）。
+        """
+        cached = newer._merged.get(id(self)) if newer._merged else None
+        if cached is not None and cached[0] is self:
+            return cached[1]
+        merged = self._merge(newer)
+        if newer._merged is None:
+            newer._merged = {}
+        newer._merged[id(self)] = (self, merged)
+        return merged
+
+    def _merge(self, newer: "Frame") -> "Frame":
+        if self.message is None or newer.message is None:
+            return newer
+        # 新しい差分に含まれないフィールドは古い差分の値のまま変わっていない
+        old_data = self.message.get("data") or {}
+        new_data = newer.message.get("data") or {}
+        data = {**old_data, **new_data}
+        if "bars" in old_data or "bars" in new_data:
+            # 時間足ごとの形成中の足も時間足ごとに重ねる（古い差分にしかない時間足を落とさない）
+            data["bars"] = {**(old_data.get("bars") or {}), **(new_data.get("bars") or {})}
+        if "seq" in old_data and old_data.get("epoch") == new_data.get("epoch"):
+            # まとめた差分が覆う通し番号の範囲（seq_from〜seq）。クライアントはこれを取りこぼしとみなさない
+            data["seq_from"] = old_data.get("seq_from", old_data["seq"])
+        return Frame.encode({**newer.message, "data": data}, newer.channel)
+
+
+class ClientConnection:
+    """1つのWebSocket接続に対する送信キューと送信タスク"""
+
+    def __init__(self, websocket: WebSocket, max_queue: int, policy: OverflowPolicy, on_close=None):
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.policy = policy
+        self.on_close = on_close
+        self.queue: Deque[Frame] = deque()
+        self.dropped = 0
+        self.closed = False
+        # 購読中のチャンネルと、まだ自分で購読していない（既定のチャンネルのままの）状態か
+        self.channels: Set[str] = set()
+        self.uses_defaults = True
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._writer())
+
+    def enqueue(self, frame: Frame) -> bool:
+        """フレームをキューに積む（ブロックしない）。切断が必要な場合はFalseを返す"""
+        if self.closed:
+            return False
+
+        if self.policy == OverflowPolicy.COALESCE and frame.type == "market_update":
+            # 同じチャンネルの未送信のmarket_updateがあれば最新のティックとまとめる
+            for i in range(len(self.queue) - 1, -1, -1):
+                if self.queue[i].type == "market_update" and self.queue[i].channel == frame.channel:
+                    self.queue[i] = self.queue[i].merge(frame)
+                    self._wakeup.set()
+                    return True
+
+        if len(self.queue) >= self.max_queue:
+            if self.policy == OverflowPolicy.DISCONNECT:
+                logger.warning("Send queue overflow, disconnecting slow client")
+                return False
+            self.queue.popleft()
+            self.dropped += 1
+
+        self.queue.append(frame)
+        self._wakeup.set()
+        return True
+
+    async def _writer(self):
+        try:
+            while not self.closed:
+                if not self.queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                frame = self.queue.popleft()
+                await self.websocket.send_text(frame.text)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Error sending to connection: {e}")
+        finally:
+            self.closed = True
+            if self.on_close:
+                self.on_close(self.websocket)
+
+    async def close(self, code: int = 1000):
+        """送信タスクを止めてソケットを閉じる"""
+        self.stop()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def stop(self):
+        self.closed = True
+        if self._task and self._task is not asyncio.current_task():
+            self._task.cancel()
+
+
+# WebSocket接続管理
+class ConnectionManager:
+    def __init__(self, max_queue: int = 100, policy: OverflowPolicy = OverflowPolicy.COALESCE, backend=None,
+                 default_channels: Iterable[str] = (), replay_size: int = 1000):
+        from services.pubsub import InProcessBackend
+
+        self.max_queue = max_queue
+        self.policy = OverflowPolicy(policy)
+        self.active_connections: Dict[WebSocket, ClientConnection] = {}
+        # チャンネル -> 購読している接続（broadcastは購読者だけを見る）
+        self.channels: Dict[str, Set[WebSocket]] = {}
+        # subscribeを送ってこない（古い）クライアントが購読していることにするチャンネル
+        self.default_channels = list(default_channels)
+        # 再接続したクライアントに取りこぼした分を送るための直近のブロードキャスト（通し番号順）
+        # market_updateは載せない（ティックでコメントが押し出されないように。相場は購読時のスナップショットと
+        # チャンネルごとのseqで追いつく）。replay_floorより後の番号はすべて再送できる
+        self.replay: Deque[Frame] = deque(maxlen=replay_size)
+        self.replay_floor = 0
+        self.last_seq = 0
+        # broadcastの配送経路（複数ワーカー時はプロセス間バス）
+        self.backend = backend or InProcessBackend()
+        # 通し番号を振っているブローカーの起動ID（別のIDの番号とは比べられない）
+        self.epoch = self.backend.epoch
+        # 配送されたフレームを受け取るコールバック（接続への送信とは別に状態を追従するため。asyncでもよい）
+        self.listeners: List[Callable[[Frame], Any]] = []
+
+    async def start(self):
+        await self.backend.start(self.deliver)
+
+    async def stop(self):
+        await self.backend.stop()
+
+    def add_listener(self, callback: Callable[[Frame], Any]):
+        self.listeners.append(callback)
+
+    async def connect(self, websocket: WebSocket):
+        await websocket.accept()
+        client = ClientConnection(websocket, self.max_queue, self.policy, on_close=self.disconnect)
+        self.active_connections[websocket] = client
+        for channel in self.default_channels:
+            self._add(client, channel)
+        client.start()
+        logger.info(f"WebSocket connected. Total connections: {len(self.active_connections)}")
+
+    def disconnect(self, websocket: WebSocket):
+        client = self.active_connections.pop(websocket, None)
+        if client is None:
+            return
+        for channel in list(client.channels):
+            self._remove(client, channel)
+        client.stop()
+        logger.info(f"WebSocket disconnected. Total connections: {len(self.active_connections)}")
+
+    def _add(self, client: ClientConnection, channel: str):
+        client.channels.add(channel)
+        self.channels.setdefault(channel, set()).add(client.websocket)
+
+    def _remove(self, client: ClientConnection, channel: str):
+        client.channels.discard(channel)
+        subscribers = self.channels.get(channel)
+        if subscribers is not None:
+            subscribers.discard(client.websocket)
+            if not subscribers:
+                del self.channels[channel]
+
+    def subscribe(self, websocket: WebSocket, channel: str) -> bool:
+        """チャンネルを購読する。新しく購読した場合はTrue"""
+        client = self.active_connections.get(websocket)
+        if client is None:
+            return False
+        if client.uses_defaults:
+            # 最初の購読で既定のチャンネルは外す（以降はクライアントが選んだものだけ）
+            client.uses_defaults = False
+            for default in self.default_channels:
+                self._remove(client, default)
+        if channel in client.channels:
+            return False
+        self._add(client, channel)
+        return True
+
+    def unsubscribe(self, websocket: WebSocket, channel: str) -> bool:
+        client = self.active_connections.get(websocket)
+        if client is None or channel not in client.channels:
+            return False
+        client.uses_defaults = False
+        self._remove(client, channel)
+        return True
+
+    def subscriptions(self, websocket: WebSocket) -> Set[str]:
+        client = self.active_connections.get(websocket)
+        return set(client.channels) if client else set()
+
+    async def send_personal(self, websocket: WebSocket, message: dict):
+        """特定の接続に送信（ブロードキャストと同じキューを通して順序を保つ）"""
+        client = self.active_connections.get(websocket)
+        if client is None:
+            return
+        if not client.enqueue(Frame.encode(message)):
+            await self._drop_slow(client)
+
+    async def broadcast(self, message: dict, channel: Optional[str] = None):
+        """全ワーカーの接続に配信（channelを指定するとその購読者だけ）"""
+        # JSONエンコードはブロードキャストごとに1回だけ行い、フレームを全接続・全ワーカーで共有する
+        if channel is not None:
+            message = {**message, "channel": channel}
+        await self.backend.publish(Frame.encode(message, channel))
+
+    async def resume(self, websocket: WebSocket, since: int, epoch: Optional[str] = None) -> bool:
+        """since より後のブロードキャストのうち購読中のものを送り直す
+
+        epochが今の番号の振り始めと違う・バッファから溢れていて送り直せない場合は
+        resync を送ってFalseを返す（クライアントは全体を取り直す）。
+        """
+        client = self.active_connections.get(websocket)
+        if client is None:
+            return False
+        if ((epoch is not None and epoch != self.epoch) or since > self.last_seq
+                or since < self.replay_floor):
+            # サーバーが再起動した / 古すぎる
+            resync = {"type": "resync", "data": {"seq": self.last_seq, "epoch": self.epoch}}
+            if not client.enqueue(Frame.encode(resync)):
+                await self._drop_slow(client)
+            return False
+
+        start = bisect.bisect_right([frame.seq for frame in self.replay], since)
+        for frame in list(self.replay)[start:]:
+            if frame.channel is not None and frame.channel not in client.channels:
+                continue
+            if not client.enqueue(frame):
+                await self._drop_slow(client)
+                return False
+        return True
+
+    async def deliver(self, frame: Frame):
+        """このプロセスの（購読している）接続の送信キューに積むだけなので、遅いクライアントが他を待たせることはない"""
+        if frame.seq is not None:
+            if frame.epoch != self.epoch:
+                # ブローカーが再起動した（前の番号のフレームは再送に使えない）
+                self.replay.clear()
+                self.replay_floor = frame.seq - 1
+                self.epoch = frame.epoch
+            self.last_seq = frame.seq
+            if frame.type != "market_update":
+                if len(self.replay) == self.replay.maxlen:
+                    self.replay_floor = self.replay[0].seq
+                self.replay.append(frame)
+
+        if frame.channel is None:
+            targets = list(self.active_connections.values())
+        else:
+            subscribers = self.channels.get(frame.channel, ())
+            targets = [self.active_connections[ws] for ws in list(subscribers) if ws in self.active_connections]
+        slow = [client for client in targets if not client.enqueue(frame)]
+
+        # 送信キューに積んだ後に呼ぶ（リスナーが送るフレームはこのフレームの後に届く）
+        for callback in self.listeners:
+            try:
+                result = callback(frame)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                logger.error(f"Error in broadcast listener: {e}")
+
+        # 溢れたクライアントを切断
+        for client in slow:
+            await self._drop_slow(client)
+
+    async def _drop_slow(self, client: ClientConnection):
+        self.disconnect(client.websocket)
+        # 1008: Policy Violation（送信が追いつかない）
+        await client.close(code=1008)
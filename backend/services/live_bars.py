@@ -0,0 +1,96 @@
+from typing import Dict, Optional, Tuple
+
+from services.bar_series import BarSeries
+
+
+class _LiveBar:
+    """形成中の1本の足（current_minute以外の分足の出来高をbase_volumeに持つ）"""
+    __slots__ = ("time", "open", "high", "low", "close", "volume", "base_volume", "minute_time")
+
+    def __init__(self, time: int, open: float, high: float, low: float, close: float, volume: float,
+                 base_volume: float = 0.0, minute_time: Optional[int] = None):
+        self.time = time
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.volume = volume
+        self.base_volume = base_volume
+        self.minute_time = minute_time
+
+    def to_dict(self) -> Dict:
+        return {
+            "time": self.time,
+            "open": self.open,
+            "high": self.high,
+            "low": self.low,
+            "close": self.close,
+            "volume": int(self.volume)
+        }
+
+
+class LiveBarAggregator:
+    """1分足から全時間足の形成中の足を組み立てる
+
+    同じ分の1分足は何度も更新されて届くので、その分の出来高は置き換え、
+    分が進んだら直前の分を確定させてbase_volumeに足し込む。
+    """
+
+    def __init__(self, timeframes: Dict[str, Tuple[int, int]]):
+        # 時間足 -> (幅(秒), 区切りの基準時刻)
+        self.timeframes = dict(timeframes)
+        self.bars: Dict[str, _LiveBar] = {}
+
+    def seed(self, name: str, bar: Dict, minute_time: Optional[int] = None, minute_volume: float = 0.0):
+        """履歴データの最後の足から始める
+
+        minute_timeはその足に含まれている最新の1分足の時刻（その分は後から届く値で置き換わる）。
+        足の時刻をそれ以降の区切りの基準にする。
+        """
+        width, _ = self.timeframes[name]
+        self.timeframes[name] = (width, int(bar["time"]) % width)
+        self.bars[name] = _LiveBar(
+            int(bar["time"]), float(bar["open"]), float(bar["high"]), float(bar["low"]),
+            float(bar["close"]), float(bar["volume"]),
+            base_volume=max(float(bar["volume"]) - minute_volume, 0.0), minute_time=minute_time
+        )
+
+    def _bucket(self, name: str, t: int) -> int:
+        width, offset = self.timeframes[name]
+        return (t - offset) // width * width + offset
+
+    def update(self, minutes: BarSeries) -> Dict[str, Dict]:
+        """直近の1分足（昇順）を取り込み、変化した時間足の形成中の足を返す"""
+        changed = {}
+        for t, o, h, l, c, v in zip(
+            minutes.time.tolist(), minutes.open.tolist(), minutes.high.tolist(),
+            minutes.low.tolist(), minutes.close.tolist(), minutes.volume.tolist()
+        ):
+            for name in self.timeframes:
+                bucket = self._bucket(name, t)
+                bar = self.bars.get(name)
+                if bar is None or bucket > bar.time:
+                    self.bars[name] = _LiveBar(bucket, o, h, l, c, v, minute_time=t)
+                    changed[name] = True
+                    continue
+                if bucket < bar.time or (bar.minute_time is not None and t < bar.minute_time):
+                    # 確定済みの足・分は更新しない
+                    continue
+
+                if bar.minute_time is not None and t > bar.minute_time:
+                    # 分が進んだので直前の分の出来高を確定させる
+                    bar.base_volume = bar.volume
+                bar.minute_time = t
+
+                before = (bar.high, bar.low, bar.close, bar.volume)
+                bar.high = max(bar.high, h)
+                bar.low = min(bar.low, l)
+                bar.close = c
+                bar.volume = bar.base_volume + v
+                if (bar.high, bar.low, bar.close, bar.volume) != before:
+                    changed[name] = True
+        return {name: self.bars[name].to_dict() for name in changed}
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """全時間足の形成中の足（接続時の初期送信用）"""
+        return {name: bar.to_dict() for name, bar in self.bars.items()}
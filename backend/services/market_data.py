@@ -1,145 +1,163 @@
-import pandas as pd
 from datetime import datetime, timedelta, timezone
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 import time
 import logging
 import json
+import re
+import uuid
 import numpy as np
-from curl_cffi import requests
+from services.bar_series import BarSeries
+from services.cache import TTLCache
+from services.live_bars import LiveBarAggregator
+from services.scheduler import PollScheduler
+from services.upstream import CircuitOpenError, ClientError, UpstreamError, YahooChartClient
 import asyncio
-import yfinance as yf
 
 logger = logging.getLogger(__name__)
 
+# Yahooのシンボルとして受け付ける形式（英数字と ^ = . -）
+SYMBOL_PATTERN = re.compile(r"^[A-Z0-9^=.\-]{1,16}$")
+# 同じ銘柄として扱うシンボル
+SYMBOL_ALIASES = {"^NDX": "NQ=F"}
+
+
+def canonical_symbol(symbol: str) -> str:
+    """キャッシュのキーに使う正規化したシンボル。受け付けない形式ならValueError"""
+    normalized = symbol.strip().upper()
+    if not SYMBOL_PATTERN.match(normalized):
+        raise ValueError(f"Invalid symbol: {symbol!r}")
+    return SYMBOL_ALIASES.get(normalized, normalized)
+
+
+def market_channel(symbol: str, interval: Optional[str] = None) -> str:
+    """market_updateのチャンネル名（market:SYMBOL は全時間足、market:SYMBOL:INTERVAL はその時間足の足だけ）"""
+    return f"market:{symbol}" if interval is None else f"market:{symbol}:{interval}"
+
+
 class MarketDataService:
-    def __init__(self):
+    def __init__(self, client: Optional[YahooChartClient] = None,
+                 max_entries: int = 256, max_bytes: int = 64 * 1024 * 1024):
         self.symbol = "NQ=F"  # NASDAQ 100 futures
-        self.cache = {}
+        # 件数とバイト数に上限のあるLRUキャッシュ（キーはcanonical_symbolで正規化したシンボル）
+        self.cache = TTLCache(max_entries=max_entries, max_bytes=max_bytes)
         self.cache_timeout = 300  # 5分のキャッシュ
         
-        # curl_cffiのセッション設定
-        self.session = requests.Session(impersonate="chrome110")
+        # Yahooへの非同期クライアント（イベントループを止めない）
+        self.client = client or YahooChartClient()
+
+        # 差分取得用: (symbol, period, yf_interval) ごとに取得済みの系列を保持
+        self.series = TTLCache(max_entries=max_entries, max_bytes=max_bytes)
+        # 時間足ごとの系列（基準系列からリサンプルしたもの）
+        self.derived = TTLCache(max_entries=max_entries, max_bytes=max_bytes)
+        # 取得したバーをディスクに残して再起動後に再利用する（BarStore）
+        self.bar_store = None
+
+        # 複数ワーカー時: リーダーだけがYahooを叩き、結果を共有メモリに書き出す
+        self.shared_state = None
+        self.is_leader = True
+        # フォロワーが共有メモリにない履歴をリーダーに頼んで待つ時間（秒。過ぎたら自分で取得する）
+        self.leader_wait = 5.0
+        # リーダーに頼んでいる (symbol, interval) と待っているリクエスト数
+        self._requests: Dict[Tuple[str, str], int] = {}
+
+        # 時間足ごとの (ソフトTTL, ハードTTL)
+        self.ttls: Dict[str, Tuple[float, float]] = dict(self.default_ttls)
+        # 実行中の更新タスク: (symbol, 基準系列) -> Task
+        self._inflight: Dict[tuple, asyncio.Task] = {}
         
-    def _get_yahoo_finance_data(self, symbol: str, period: str, interval: str) -> pd.DataFrame:
-        """Yahoo Finance APIから直接データを取得（同期）"""
+    # 期間を秒単位に変換
+    period_map = {
+        "1d": 86400,
+        "2d": 172800,
+        "5d": 432000,
+        "1mo": 2592000,
+        "3mo": 7776000,
+        "6mo": 15552000,
+        "1y": 31536000,
+        "2y": 63072000,
+        "5y": 157680000,
+        "10y": 315360000,
+        "max": 3153600000
+    }
+
+    # Yahooから取得する基準系列（解像度ごとに1本）: tier -> (period, yf_interval)
+    tiers = {
+        "1m": ("5d", "1m"),
+        "1h": ("6mo", "1h"),
+        "1d": ("5y", "1d"),
+    }
+    # 基準系列の1本の長さ（秒）
+    tier_seconds = {"1m": 60, "1h": 3600, "1d": 86400}
+
+    # 週足は月曜 00:00 UTC 区切り（1970-01-01は木曜）
+    WEEK_OFFSET = 4 * 86400
+
+    # チャートの時間足 -> (基準系列, リサンプル幅(秒, Noneならそのまま), 区切りの基準, 表示期間)
+    timeframes = {
+        "1m": ("1m", None, 0, "2d"),
+        "3m": ("1m", 180, 0, "5d"),
+        "5m": ("1m", 300, 0, "5d"),
+        "15m": ("1m", 900, 0, "5d"),
+        "1H": ("1h", None, 0, "3mo"),
+        "4H": ("1h", 4 * 3600, 0, "6mo"),
+        "1D": ("1d", None, 0, "2y"),
+        "1W": ("1d", 7 * 86400, WEEK_OFFSET, "5y"),
+    }
+
+    # 時間足 -> (ソフトTTL, ハードTTL) 秒
+    # ソフトTTLを過ぎたらバックグラウンドで更新、ハードTTLを過ぎたら更新を待つ
+    default_ttls = {
+        "1m": (60, 600),
+        "3m": (120, 900),
+        "5m": (120, 900),
+        "15m": (300, 1800),
+        "1H": (600, 3600),
+        "4H": (900, 7200),
+        "1D": (1800, 21600),
+        "1W": (3600, 86400),
+    }
+
+    async def _get_yahoo_finance_data(self, symbol: str, period: str, interval: str, start: Optional[int] = None) -> BarSeries:
+        """Yahoo Finance APIから非同期でデータを取得。startを指定するとその時刻以降だけを取得
+
+        取得できなかった場合（サーキットブレーカーが開いている場合を含む）は空の系列を返すので、
+        呼び出し側は手元の最後に取得できた系列をそのまま使う。
+        """
+        # 現在時刻と開始時刻を計算
+        period2 = int(time.time())
+        period1 = start if start is not None else period2 - self.period_map.get(period, 86400)
         try:
-            # 期間を秒単位に変換
-            period_map = {
-                "1d": 86400,
-                "2d": 172800,
-                "5d": 432000,
-                "1mo": 2592000,
-                "3mo": 7776000,
-                "6mo": 15552000,
-                "1y": 31536000,
-                "2y": 63072000,
-                "5y": 157680000,
-                "10y": 315360000,
-                "max": 3153600000
-            }
-            
-            # 現在時刻と開始時刻を計算
-            period2 = int(time.time())
-            period1 = period2 - period_map.get(period, 86400)
-            
-            # Yahoo Finance APIのURL
-            url = f"https://query1.finance.yahoo.com/v8/finance/chart/{symbol}"
-            
-            params = {
-                "period1": period1,
-                "period2": period2,
-                "interval": interval,
-                "includePrePost": "true",
-                "events": "div%7Csplit%7Ccapitalgains",
-                "useYfid": "true",
-                "includeAdjustedClose": "true"
-            }
-            
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36",
-                "Accept": "application/json",
-                "Accept-Language": "en-US,en;q=0.9",
-                "Accept-Encoding": "gzip, deflate, br",
-                "Cache-Control": "no-cache",
-                "Pragma": "no-cache",
-                "Sec-Fetch-Dest": "empty",
-                "Sec-Fetch-Mode": "cors",
-                "Sec-Fetch-Site": "same-site"
-            }
-            
-            response = self.session.get(url, params=params, headers=headers)
-            
-            if response.status_code != 200:
-                logger.error(f"Failed to fetch data: HTTP {response.status_code}")
-                return pd.DataFrame()
-            
-            data = response.json()
-            
-            # データの解析
-            if 'chart' not in data or 'result' not in data['chart'] or len(data['chart']['result']) == 0:
-                logger.error("Invalid response structure from Yahoo Finance")
-                return pd.DataFrame()
-            
-            result = data['chart']['result'][0]
-            
-            if 'timestamp' not in result:
-                logger.error("No timestamp data in response")
-                return pd.DataFrame()
-            
-            # タイムスタンプ
-            timestamps = result['timestamp']
-            
-            # 価格データ
-            quotes = result['indicators']['quote'][0]
-            
-            # DataFrameを作成
-            df_data = {
-                'timestamp': timestamps,
-                'Open': quotes.get('open', []),
-                'High': quotes.get('high', []),
-                'Low': quotes.get('low', []),
-                'Close': quotes.get('close', []),
-                'Volume': quotes.get('volume', [])
-            }
-            
-            df = pd.DataFrame(df_data)
-            df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s')
-            df.set_index('timestamp', inplace=True)
-            
-            # NaNを除去
-            df = df.dropna()
-            
-            return df
-            
-        except Exception as e:
+            return await self.client.fetch_chart(symbol, interval, period1, period2)
+        except CircuitOpenError as e:
+            logger.debug(str(e))
+        except UpstreamError as e:
             logger.error(f"Error fetching data from Yahoo Finance: {e}")
-            return pd.DataFrame()
+        return BarSeries.empty()
         
-    def get_latest_data(self) -> Dict:
+    async def get_latest_data(self) -> Dict:
         """最新の価格データを取得（互換性のために残すが、リアルタイムは別メソッドで処理）"""
         cache_key = f"latest_{self.symbol}"
-        if cache_key in self.cache:
-            cached_data, cached_time = self.cache[cache_key]
-            if time.time() - cached_time < self.cache_timeout:
-                return cached_data
+        cached_data = self.cache.get(cache_key)
+        if cached_data is not None:
+            return cached_data
         
         try:
-            df = self._get_yahoo_finance_data(self.symbol, "2d", "1m")
-            if df.empty:
+            series = await self._get_yahoo_finance_data(self.symbol, "2d", "1m")
+            if len(series) == 0:
                 return self._get_default_latest_data()
             
-            latest = df.iloc[-1]
-            previous_close = df.iloc[0]['Close'] if len(df) > 1 else latest['Close']
+            latest_close = float(series.close[-1])
+            previous_close = float(series.close[0])
             
             data = {
                 "symbol": self.symbol,
-                "price": float(latest['Close']),
-                "change": float(latest['Close'] - previous_close),
-                "changePercent": float((latest['Close'] - previous_close) / previous_close * 100) if previous_close != 0 else 0,
+                "price": latest_close,
+                "change": latest_close - previous_close,
+                "changePercent": (latest_close - previous_close) / previous_close * 100 if previous_close != 0 else 0,
                 "timestamp": datetime.now().isoformat()
             }
             
-            self.cache[cache_key] = (data, time.time())
+            self.cache.set(cache_key, data, ttl=self.cache_timeout)
             return data
             
         except Exception as e:
@@ -154,67 +172,230 @@ class MarketDataService:
             "timestamp": datetime.now().isoformat()
         }
     
-    def get_historical_data(self, symbol: str, interval: str) -> List[Dict]:
-        """履歴データを取得"""
+    async def get_historical_data(self, symbol: str, interval: str) -> BarSeries:
+        """履歴データを取得
+
+        ソフトTTLを過ぎたデータはそのまま返してバックグラウンドで更新し（stale-while-revalidate）、
+        ハードTTLを過ぎた場合だけ更新を待つ。同じ基準系列の更新は同時に1つしか走らない。
+        """
+        if interval not in self.timeframes:
+            interval = "1D"
+        symbol = canonical_symbol(symbol)
         cache_key = f"historical_{symbol}_{interval}"
-        if cache_key in self.cache:
-            cached_data, cached_time = self.cache[cache_key]
-            if time.time() - cached_time < self.cache_timeout:
-                return cached_data
-        
-        period_interval_map = {
-            "1m": ("2d", "1m"),
-            "3m": ("5d", "5m"),
-            "5m": ("5d", "5m"),
-            "15m": ("1mo", "15m"),
-            "1H": ("3mo", "1h"),
-            "4H": ("6mo", "1h"),
-            "1D": ("2y", "1d"),
-            "1W": ("5y", "1wk")
-        }
-        
-        period, yf_interval = period_interval_map.get(interval, ("1mo", "1d"))
-        
+        soft_ttl, hard_ttl = self.ttls[interval]
+        tier = self.timeframes[interval][0]
+
+        entry = self.cache.get_entry(cache_key)
+        # フォロワーはリーダーが共有メモリに書いたデータを使う（更新はリーダーが行う）
+        follower = not self.is_leader and self.shared_state is not None
+        if follower:
+            shared = self.shared_state.read_historical(cache_key)
+            if shared and (entry is None or shared[1] > entry[1]):
+                # 配列への変換はリーダーが書き直したときだけ（格納時刻が同じ間はキャッシュのものを使う）
+                entry = (BarSeries.from_columns(shared[0]), shared[1])
+                self.cache.set(cache_key, entry[0], ttl=hard_ttl, stored_at=entry[1])
+
+        if entry is not None:
+            data, cached_time = entry
+            age = time.time() - cached_time
+            if age < soft_ttl:
+                return data
+            if age < hard_ttl:
+                if not follower:
+                    self._revalidate(symbol, tier)
+                return data
+
+        if follower:
+            # 自分でYahooに行くとワーカー数だけ問い合わせが増えるので、まずリーダーに頼んで待つ
+            fresh = await self._wait_for_leader(symbol, interval, cache_key, entry[1] if entry else 0.0)
+            if fresh is not None:
+                return fresh
+            if entry is not None:
+                # リーダーが応えなくても古いデータがあればそれを返す
+                return entry[0]
+
+        # 期限切れまたは未取得: 更新を待つ（他のリクエストが始めた更新があればそれを待つ）
+        await asyncio.shield(self._revalidate(symbol, tier))
+        entry = self.cache.get_entry(cache_key)
+        if entry is None:
+            return self._generate_dummy_data(interval)
+        return entry[0]
+
+    async def _wait_for_leader(self, symbol: str, interval: str, cache_key: str,
+                               newer_than: float) -> Optional[BarSeries]:
+        """リーダーに取得を頼み、newer_thanより新しいものが共有メモリに載るまで最大leader_wait秒待つ"""
+        key = (symbol, interval)
+        self._requests[key] = self._requests.get(key, 0) + 1
+        if self._requests[key] == 1:
+            self.shared_state.publish_requests(list(self._requests))
         try:
-            if symbol == "^NDX":
-                symbol = "NQ=F"
-            
-            df = self._get_yahoo_finance_data(symbol, period, yf_interval)
-            
-            if df.empty:
-                return self._generate_dummy_data(interval)
-            
-            if interval == "4H":
-                df = self._convert_to_4h(df)
-            
-            data = []
-            for index, row in df.iterrows():
-                data.append({
-                    "time": int(index.timestamp()),
-                    "open": float(row["Open"]),
-                    "high": float(row["High"]),
-                    "low": float(row["Low"]),
-                    "close": float(row["Close"]),
-                    "volume": int(row["Volume"]) if not pd.isna(row["Volume"]) else 0
-                })
-            
-            self.cache[cache_key] = (data, time.time())
-            return data
-            
+            deadline = time.monotonic() + self.leader_wait
+            while time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+                shared = self.shared_state.read_historical(cache_key)
+                if shared and shared[1] > newer_than:
+                    series = BarSeries.from_columns(shared[0])
+                    self.cache.set(cache_key, series, ttl=self.ttls[interval][1], stored_at=shared[1])
+                    return series
+            logger.warning(f"Leader did not publish {cache_key} within {self.leader_wait} s")
+            return None
+        finally:
+            self._requests[key] -= 1
+            if not self._requests[key]:
+                del self._requests[key]
+                self.shared_state.publish_requests(list(self._requests))
+
+    async def serve_requests(self, interval: float = 0.2):
+        """リーダー用: フォロワーが頼んだ履歴を取得して共有メモリに載せる"""
+        served: Dict[Tuple[str, str], float] = {}
+        while True:
+            try:
+                now = time.monotonic()
+                requests = self.shared_state.read_requests()
+                for key in requests:
+                    # フォロワーが待っている間に同じ依頼で何度もYahooに行かない（失敗した銘柄など）
+                    if now - served.get(key, float("-inf")) < self.leader_wait:
+                        continue
+                    served[key] = now
+                    asyncio.create_task(self._serve_request(*key))
+                for key in [key for key in served if key not in requests]:
+                    del served[key]
+            except Exception as e:
+                logger.error(f"Error reading historical requests: {e}")
+            await asyncio.sleep(interval)
+
+    async def _serve_request(self, symbol: str, interval: str):
+        try:
+            await self.get_historical_data(symbol, interval)
         except Exception as e:
-            return self._generate_dummy_data(interval)
-    
-    def _convert_to_4h(self, df: pd.DataFrame) -> pd.DataFrame:
-        df_4h = df.resample('4H').agg({
-            'Open': 'first',
-            'High': 'max',
-            'Low': 'min',
-            'Close': 'last',
-            'Volume': 'sum'
-        }).dropna()
-        return df_4h
+            logger.error(f"Error serving historical request {symbol} {interval}: {e}")
+
+    def _revalidate(self, symbol: str, tier: str) -> asyncio.Task:
+        """(symbol, 基準系列) ごとに更新タスクを1つだけ走らせる（single-flight）"""
+        key = (symbol, tier)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._refresh(symbol, tier))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return task
+
+    async def _refresh(self, symbol: str, tier: str):
+        """基準系列を更新して、そこから作る全時間足のキャッシュを差し替える"""
+        try:
+            # 基準系列を1回更新すると、その系列から作る全時間足がまとめて更新される
+            await self._refresh_tier(symbol, tier)
+
+            now = time.time()
+            for name, (tf_tier, _, _, window) in self.timeframes.items():
+                derived = self.derived.get((symbol, name))
+                if tf_tier == tier and derived is not None and len(derived):
+                    view = derived.slice_time(start=int(now) - self.period_map[window])
+                    cache_key = f"historical_{symbol}_{name}"
+                    self.cache.set(cache_key, view, ttl=self.ttls[name][1], stored_at=now)
+                    self._publish_historical(cache_key, view, now)
+        except Exception as e:
+            logger.error(f"Error refreshing historical data for {symbol} {tier}: {e}")
+
+    def cache_stats(self) -> Dict[str, Dict]:
+        """キャッシュごとの件数・バイト数・ヒット率"""
+        return {
+            "historical": self.cache.stats(),
+            "series": self.series.stats(),
+            "derived": self.derived.stats(),
+        }
+
+    def set_ttls(self, spec: str):
+        """"1m=60:600,1D=1800:21600" 形式で時間足ごとの (ソフトTTL, ハードTTL) 秒を上書きする"""
+        for item in filter(None, (part.strip() for part in spec.split(","))):
+            interval, _, ttls = item.partition("=")
+            soft, _, hard = ttls.partition(":")
+            if interval not in self.timeframes or not soft or not hard:
+                raise ValueError(f"Invalid TTL setting: {item}")
+            if float(hard) < float(soft):
+                raise ValueError(f"Hard TTL must not be shorter than soft TTL: {item}")
+            self.ttls[interval] = (float(soft), float(hard))
+
+    async def _refresh_tier(self, symbol: str, tier: str):
+        """基準系列を差分更新し、そこから派生する時間足を変化した足の分だけ作り直す"""
+        period, yf_interval = self.tiers[tier]
+        base, changed_since = await self._refresh_series(symbol, period, yf_interval)
+
+        for name, (tf_tier, width, offset, _) in self.timeframes.items():
+            if tf_tier != tier:
+                continue
+            key = (symbol, name)
+            if width is None:
+                self.derived[key] = base
+                continue
+            derived = self.derived.get(key)
+            if derived is None or changed_since is None:
+                self.derived[key] = base.resample(width, offset)
+            else:
+                # 変化したバーを含む足の先頭から作り直してマージ
+                bucket_start = (changed_since - offset) // width * width + offset
+                derived = derived.merge(base.slice_time(start=bucket_start).resample(width, offset))
+                # 基準系列から外れた古い足を落とす
+                first_bucket = (int(base.time[0]) - offset) // width * width + offset
+                self.derived[key] = derived.slice_time(start=first_bucket)
+
+    async def _refresh_series(self, symbol: str, period: str, yf_interval: str) -> Tuple[BarSeries, Optional[int]]:
+        """前回取得した最後のバー以降だけを取得して系列にマージする
+
+        (系列, 変化した最初のバーの時刻) を返す。系列全体が新しい場合の時刻はNone
+        """
+        key = (symbol, period, yf_interval)
+        cached = self.series.get(key)
+        oldest = int(time.time()) - self.period_map.get(period, 86400)
+        loaded = False
+
+        if (cached is None or len(cached) == 0) and self.bar_store:
+            # 再起動直後はディスクに保存済みのバーから再開する
+            cached = self.bar_store.load(symbol, yf_interval, start=oldest)
+            loaded = True
+
+        if cached is None or len(cached) == 0:
+            series = new_series = await self._get_yahoo_finance_data(symbol, period, yf_interval)
+            changed_since = None
+        else:
+            # 最後のバーはまだ確定していない可能性があるので、そのバーから取り直す
+            new_series = await self._get_yahoo_finance_data(symbol, period, yf_interval, start=cached.last_time)
+            if len(new_series) == 0:
+                self.series[key] = cached
+                return cached, None if loaded else cached.last_time
+            series = cached.merge(new_series)
+            changed_since = None if loaded else int(new_series.time[0])
+
+            # 期間外になった古いバーを落とす
+            series = series.slice_time(start=oldest)
+
+        if len(series):
+            self.series[key] = series
+            # ファイルへの書き込みはリーダーだけが行う
+            if self.bar_store and self.is_leader:
+                try:
+                    self.bar_store.append(symbol, yf_interval, new_series)
+                except Exception as e:
+                    logger.error(f"Error persisting bars for {symbol} {yf_interval}: {e}")
+        return series, changed_since
+
+    def _publish_historical(self, cache_key: str, series: BarSeries, cached_time: float):
+        # 更新したキーの分だけ書く（他のキーのセグメントには触らない）
+        if self.is_leader and self.shared_state:
+            self.shared_state.publish_historical(cache_key, series.to_columns(), cached_time)
+
+    async def keep_warm(self, symbol: str, intervals: List[str]):
+        """リーダー用: ソフトTTLを過ぎた時間足を取得し直して共有メモリに載せ続ける"""
+        while True:
+            for interval in intervals:
+                try:
+                    await self.get_historical_data(symbol, interval)
+                except Exception as e:
+                    logger.error(f"Error warming {symbol} {interval}: {e}")
+            # 最も短いソフトTTLごとに見回る（新しいものはキャッシュから返るだけ）
+            await asyncio.sleep(max(min((self.ttls[i][0] for i in intervals if i in self.ttls), default=self.cache_timeout), 30))
     
-    def _generate_dummy_data(self, interval: str) -> List[Dict]:
+    def _generate_dummy_data(self, interval: str) -> BarSeries:
         import random
         now = datetime.now()
         data = []
@@ -239,69 +420,362 @@ class MarketDataService:
                 "volume": random.randint(1000000, 10000000)
             })
             base_price = close_price
-        return data
+        return BarSeries.from_records(data)
+
+
+class SymbolStream:
+    """銘柄ごとのリアルタイム状態（最新バー・形成中の足・通し番号）"""
+
+    def __init__(self, symbol: str):
+        self.symbol = symbol
+        self.latest_price: Optional[Dict] = None
+        self.live_bars: Optional[LiveBarAggregator] = None
+        # market_updateの通し番号（クライアントが取りこぼしを検知するため）
+        # sequenceは market:SYMBOL、channel_seqは時間足ごとのチャンネルの番号
+        self.sequence = 0
+        self.channel_seq: Dict[str, int] = {}
+        # 番号を振り始めたときのID（再起動・リーダー交代・銘柄の見直しで番号が0に戻ったことを見分ける）
+        self.epoch = uuid.uuid4().hex[:8]
+        # 形成中の足を履歴から作るタスク（ポーリングの回とは別に走らせる）
+        self.seeding: Optional[asyncio.Task] = None
+        # 存在しない銘柄など4xxが続いた回数と、次に問い合わせる時刻
+        self.client_errors = 0
+        self.retry_at = 0.0
+
+    def diff(self, market_data: Dict) -> Optional[Dict]:
+        """latest_priceと比較して変化したフィールドだけを返す。変化がなければNone"""
+        if self.latest_price is None:
+            return dict(market_data)
+
+        delta = {
+            key: value for key, value in market_data.items()
+            if self.latest_price.get(key) != value
+        }
+        if not delta:
+            return None
+
+        # どのバーに対する差分かを識別できるよう symbol と time は常に含める
+        delta["symbol"] = market_data["symbol"]
+        delta["time"] = market_data["time"]
+        return delta
 
 
 class RealtimeMarketService:
-    def __init__(self, broadcast_func=None):
+    # 1回のポーリングで取得する直近の期間（秒）
+    poll_window = 300
+    # 需要がなくても常にポーリングする銘柄
+    default_symbol = "NQ=F"
+    # 4xxが返った銘柄を次に問い合わせるまでの時間（秒、続くたびに倍にする）
+    client_error_backoff = 30
+    max_client_error_backoff = 3600
+
+    def __init__(self, broadcast_func=None, client: Optional[YahooChartClient] = None,
+                 market_service: Optional[MarketDataService] = None,
+                 scheduler: Optional[PollScheduler] = None, client_count=None,
+                 max_concurrency: int = 4, max_symbols: int = 50):
         self.broadcast_func = broadcast_func
+        # ポーリング間隔は取引時間・値動き・接続数から決める
+        self.scheduler = scheduler or PollScheduler()
+        self.client_count = client_count or (lambda: 0)
+        self.client = client or YahooChartClient()
+        # 形成中の足の初期値を履歴データから取る
+        self.market_service = market_service
         self.is_running = False
-        self.latest_price = None
-        self.symbol = "NQ=F"
+        self.shared_state = None
+
+        # 銘柄ごとの状態と、その銘柄を見ている接続の数
+        self.streams: Dict[str, SymbolStream] = {}
+        self.demand: Dict[str, int] = {}
+        # 時間足ごとのチャンネルを購読している接続の数（購読者のいないチャンネルには配信しない）
+        self.channel_demand: Dict[str, int] = {}
+        self.active_channels: set = set()
+        # 1回のポーリングでYahooに同時に投げるリクエスト数の上限
+        self.max_concurrency = max_concurrency
+        # 全ワーカーで見られる銘柄数の上限（常時の銘柄は含めない）
+        self.max_symbols = max_symbols
+
+    def watch(self, symbol: str) -> str:
+        """接続が銘柄を見始めた（正規化したシンボルを返す。不正な形式はValueError）"""
+        symbol = canonical_symbol(symbol)
+        self._acquire(self.demand, symbol)
+        return symbol
+
+    def unwatch(self, symbol: str):
+        """接続が銘柄を見るのをやめた"""
+        self._release(self.demand, symbol)
+
+    def watch_channel(self, channel: str):
+        """接続が時間足ごとのチャンネル（market:SYMBOL:INTERVAL）を購読した"""
+        self._acquire(self.channel_demand, channel)
+
+    def unwatch_channel(self, channel: str):
+        self._release(self.channel_demand, channel)
+
+    def _acquire(self, counts: Dict[str, int], key: str):
+        counts[key] = counts.get(key, 0) + 1
+        if counts[key] == 1:
+            self._publish_demand()
+
+    def _release(self, counts: Dict[str, int], key: str):
+        count = counts.get(key, 0) - 1
+        if count > 0:
+            counts[key] = count
+            return
+        if counts.pop(key, None) is not None:
+            self._publish_demand()
+
+    def connections_changed(self):
+        """このワーカーの接続数が変わった（ポーリング間隔は全ワーカーの合計で決める）"""
+        self._publish_demand()
+
+    def _publish_demand(self):
+        # リーダー以外のワーカーの接続が見ている銘柄・接続数もリーダーが使えるようにする
+        if self.shared_state:
+            self.shared_state.publish_demand(list(self.demand), self.client_count(), list(self.channel_demand))
+
+    def total_client_count(self) -> int:
+        """全ワーカーの接続数（共有メモリがなければこのワーカーの分だけ）"""
+        if self.shared_state:
+            return self.shared_state.read_client_count()
+        return self.client_count()
+
+    def _watched_symbols(self) -> set:
+        symbols = set(self.demand)
+        if self.shared_state:
+            symbols.update(self.shared_state.read_demand())
+        symbols.discard(self.default_symbol)
+        return symbols
+
+    def can_watch(self, symbol: str) -> bool:
+        """銘柄数の上限を超えずにこの銘柄を見始められるか"""
+        symbol = canonical_symbol(symbol)
+        if symbol == self.default_symbol:
+            return True
+        symbols = self._watched_symbols()
+        return symbol in symbols or len(symbols) < self.max_symbols
+
+    def _watched_channels(self) -> set:
+        channels = set(self.channel_demand)
+        if self.shared_state:
+            channels.update(self.shared_state.read_demand_channels())
+        return channels
+
+    def active_symbols(self) -> List[str]:
+        """ポーリング対象（常時の銘柄 + いずれかの接続が見ている銘柄、上限まで）"""
+        # ワーカー間で同時に見始めた場合でも上限を超えてはポーリングしない
+        symbols = sorted(self._watched_symbols())[:self.max_symbols]
+        return sorted({self.default_symbol, *symbols})
+
+    def current_snapshot(self, symbol: Optional[str] = None, interval: Optional[str] = None) -> Optional[Dict]:
+        """最新バー全体（フォロワーはリーダーが共有メモリに書いたものを読む）
+
+        intervalを指定すると market:SYMBOL:INTERVAL チャンネルの形（その時間足の足とチャンネルの番号）で返す。
+        """
+        symbol = symbol or self.default_symbol
+        if self.is_running or self.shared_state is None:
+            stream = self.streams.get(symbol)
+            latest = stream.latest_price if stream else None
+        else:
+            latest = (self.shared_state.read_latest() or {}).get(symbol)
+        if latest is None:
+            return None
+
+        snapshot = {key: value for key, value in latest.items() if key != "seqs"}
+        if interval is not None:
+            bar = latest.get("bars", {}).get(interval)
+            snapshot["bars"] = {interval: bar} if bar else {}
+            snapshot["seq"] = latest.get("seqs", {}).get(interval, 0)
+        return snapshot
+
+    async def _seed_live_bars(self, symbol: str) -> LiveBarAggregator:
+        """全時間足の形成中の足を履歴データの最後の足から始める"""
+        timeframes = {
+            name: (width or MarketDataService.tier_seconds[tier], offset)
+            for name, (tier, width, offset, _) in MarketDataService.timeframes.items()
+        }
+        aggregator = LiveBarAggregator(timeframes)
+        if self.market_service is None:
+            return aggregator
+
+        # 基準系列ごとに1回取得すれば、その系列から作る時間足がすべて揃う
+        for tier in MarketDataService.tiers:
+            interval = next(name for name, tf in MarketDataService.timeframes.items() if tf[0] == tier)
+            await self.market_service.get_historical_data(symbol, interval)
+
+        # 取得できた系列だけを使う（ダミーデータでは始めない）
+        minute_series = self.market_service.derived.get((symbol, "1m"))
+        minute = minute_series.last_bar() if minute_series is not None else None
+        for name, (width, offset) in timeframes.items():
+            series = self.market_service.derived.get((symbol, name))
+            last = series.last_bar() if series is not None else None
+            if last is not None:
+                # 区切りは履歴データの足に合わせる（日足は取引所の時刻で区切られている）
+                offset = int(last["time"]) % width
+            if minute is None:
+                if last is not None:
+                    aggregator.seed(name, last)
+                continue
+            # 時間足の系列の最後の足は古いことがあるので、最新の1分足を含む足を1分足から作り直す。
+            # 最新の1分足はまだ形成中なので、その分の出来高は後から届く値で置き換える
+            bar = self._bar_from_minutes(symbol, name, minute_series, width, offset, minute["time"])
+            aggregator.seed(name, bar, minute_time=minute["time"], minute_volume=minute["volume"])
+        return aggregator
+
+    def _bar_from_minutes(self, symbol: str, name: str, minutes: BarSeries,
+                          width: int, offset: int, minute_time: int) -> Dict:
+        """minute_timeを含む足をその足の先頭からの1分足で作る
+
+        1分足が足の先頭まで残っていない場合（週足など）は、確定した基準系列の足とその後の1分足で作る。
+        """
+        start = (minute_time - offset) // width * width + offset
+        parts = minutes.slice_time(start=start)
+        tier = MarketDataService.timeframes[name][0]
+        if tier != "1m" and int(parts.time[0]) > start:
+            base_name = next(n for n, (t, w, _, _) in MarketDataService.timeframes.items() if t == tier and w is None)
+            base = self.market_service.derived.get((symbol, base_name))
+            if base is not None:
+                base_width = MarketDataService.tier_seconds[tier]
+                closed = base.slice_time(start=start, end=minute_time - base_width)
+                if len(closed):
+                    parts = closed.merge(minutes.slice_time(start=int(closed.time[-1]) + base_width))
+        return parts.resample(width, offset).last_bar()
+
+    async def _seed(self, stream: SymbolStream):
+        try:
+            stream.live_bars = await self._seed_live_bars(stream.symbol)
+        except Exception as e:
+            logger.error(f"Error seeding live bars for {stream.symbol}: {e}")
+        finally:
+            stream.seeding = None
+
+    async def _poll(self, symbol: str, semaphore: asyncio.Semaphore) -> bool:
+        """1銘柄の直近の1分足を取得して配信する。何か変化したらTrue"""
+        stream = self.streams.get(symbol)
+        if stream is None:
+            stream = self.streams[symbol] = SymbolStream(symbol)
+
+        if stream.live_bars is None:
+            # 履歴の取得は時間がかかるので回の外で行い、揃うまでこの銘柄はポーリングしない
+            if stream.seeding is None:
+                stream.seeding = asyncio.create_task(self._seed(stream))
+            return False
+        if time.monotonic() < stream.retry_at:
+            return False
+
+        try:
+            async with semaphore:
+                now = int(time.time())
+                series = await self.client.fetch_chart(symbol, "1m", now - self.poll_window, now)
+        except CircuitOpenError as e:
+            logger.debug(str(e))
+            return False
+        except ClientError as e:
+            # 存在しない銘柄などは毎回問い合わせず、間隔を倍にしながら待つ
+            backoff = min(self.client_error_backoff * 2 ** stream.client_errors, self.max_client_error_backoff)
+            stream.client_errors += 1
+            stream.retry_at = time.monotonic() + backoff
+            log = logger.warning if stream.client_errors == 1 else logger.debug
+            log(f"Error polling {symbol}: {e} (retry in {backoff:.0f} s)")
+            return False
+        except Exception as e:
+            logger.error(f"Error polling {symbol}: {e}")
+            return False
+        stream.client_errors = 0
+
+        if len(series) == 0:
+            return False
+
+        bars = stream.live_bars.update(series)
+        current_price = float(series.close[-1])
+
+        market_data = {
+            "symbol": symbol,
+            "price": current_price,
+            "time": int(series.time[-1]), # UNIX time (frontend expects 'time')
+            "open": float(series.open[-1]),
+            "high": float(series.high[-1]),
+            "low": float(series.low[-1]),
+            "close": current_price,
+            "volume": int(series.volume[-1])
+        }
+
+        # 前回のバーとの差分と、変化した時間足の足だけを送る（変化がなければ何も送らない）
+        delta = stream.diff(market_data)
+        if delta is None and bars:
+            delta = {"symbol": symbol, "time": market_data["time"]}
+        if delta is None:
+            return False
+        fields = dict(delta)
+        if bars:
+            delta["bars"] = bars
+        stream.sequence += 1
+        delta["seq"] = stream.sequence
+        delta["epoch"] = stream.epoch
+        for name in bars:
+            stream.channel_seq[name] = stream.channel_seq.get(name, 0) + 1
+
+        # メモリに保持（接続時の初期送信用に全フィールドと全時間足の足を持つ）
+        stream.latest_price = {
+            **market_data, "bars": stream.live_bars.snapshot(),
+            "seq": stream.sequence, "seqs": dict(stream.channel_seq), "epoch": stream.epoch
+        }
+
+        # ブロードキャスト（全時間足のチャンネルと、変化した時間足ごとのチャンネル）
+        if self.broadcast_func:
+            await self.broadcast_func({
+                "type": "market_update",
+                "data": delta
+            }, market_channel(symbol))
+            for name, bar in bars.items():
+                if market_channel(symbol, name) not in self.active_channels:
+                    continue
+                await self.broadcast_func({
+                    "type": "market_update",
+                    "data": {**fields, "bars": {name: bar}, "seq": stream.channel_seq[name],
+                             "epoch": stream.epoch}
+                }, market_channel(symbol, name))
+        return True
 
     async def start_stream(self):
         """リアルタイムデータストリーミングを開始"""
         self.is_running = True
-        logger.info(f"Starting realtime stream for {self.symbol}")
+        logger.info(f"Starting realtime stream (pinned {self.default_symbol})")
 
         try:
-            # yfinanceのTickerオブジェクトを作成
-            ticker = yf.Ticker(self.symbol)
+            semaphore = asyncio.Semaphore(self.max_concurrency)
 
             # 高頻度ポーリングループ（WebSocket風の挙動を模倣）
-            # 注意: yfinanceの公式ストリーミングAPIがない場合、
-            # fast_infoやhistoryを短間隔で叩くのが最も確実な「準リアルタイム」手法
+            # 見られている銘柄ごとに直近数分の1分足だけを並行して取得する
+            # （コストは接続数ではなく銘柄数に比例する）
             while self.is_running:
                 try:
-                    # 最新価格を取得（fast_infoは比較的軽量）
-                    # または history(period='1d', interval='1m') の最後のデータを取得
-                    # 同期的なI/O操作をスレッドプールで実行
-                    df = await asyncio.to_thread(ticker.history, period="1d", interval="1m")
-
-                    if not df.empty:
-                        latest = df.iloc[-1]
-                        current_price = float(latest['Close'])
-
-                        # データが更新されたか、あるいは強制的に送信するか
-                        # ここではシンプルに毎回送信（クライアント側で処理）
-
-                        market_data = {
-                            "symbol": self.symbol,
-                            "price": current_price,
-                            "time": int(latest.name.timestamp()), # UNIX time (frontend expects 'time')
-                            "open": float(latest['Open']),
-                            "high": float(latest['High']),
-                            "low": float(latest['Low']),
-                            "close": float(latest['Close']),
-                            "volume": int(latest['Volume'])
-                        }
-
-                        # メモリに保持
-                        self.latest_price = market_data
-
-                        # ブロードキャスト
-                        if self.broadcast_func:
-                            await self.broadcast_func({
-                                "type": "market_update",
-                                "data": market_data
-                            })
-                            # logger.info(f"Broadcasted realtime price: {current_price}")
+                    symbols = self.active_symbols()
+                    self.active_channels = self._watched_channels()
+                    # 誰も見なくなった銘柄の状態は捨てる
+                    for symbol in list(self.streams):
+                        if symbol not in symbols:
+                            stream = self.streams.pop(symbol)
+                            if stream.seeding is not None:
+                                stream.seeding.cancel()
+
+                    results = await asyncio.gather(*(self._poll(symbol, semaphore) for symbol in symbols))
+                    changed = any(results)
+
+                    if changed and self.shared_state:
+                        self.shared_state.publish_latest({
+                            symbol: stream.latest_price
+                            for symbol, stream in self.streams.items() if stream.latest_price
+                        })
+
+                    pinned = self.streams.get(self.default_symbol)
+                    price = pinned.latest_price["price"] if pinned and pinned.latest_price else None
+                    self.scheduler.record(changed, price)
 
                 except Exception as e:
                     logger.error(f"Error in realtime stream loop: {e}")
 
-                # 1秒待機（API制限を考慮しつつリアルタイム性を確保）
-                await asyncio.sleep(2)
+                # 取引時間外は再開まで待ち、取引中は状況に応じた間隔で待つ
+                await asyncio.sleep(self.scheduler.next_interval(self.total_client_count()))
 
         except Exception as e:
             logger.error(f"Fatal error in realtime stream: {e}")
@@ -0,0 +1,219 @@
+import asyncio
+import fcntl
+import logging
+import os
+import random
+import uuid
+from typing import Awaitable, Callable, Optional, Set
+
+from services.connection_manager import Frame
+
+logger = logging.getLogger(__name__)
+
+DeliverFunc = Callable[[Frame], Awaitable[None]]
+
+# 1フレームの最大長（コメント本文を含むため余裕を持たせる）
+MAX_LINE_BYTES = 16 * 1024 * 1024
+# ハブが1ワーカーに対して溜め込める未送信バイト数
+MAX_PEER_BUFFER = 8 * 1024 * 1024
+
+
+class BroadcastBackend:
+    """ConnectionManager.broadcast の配送経路（プロセス内 / プロセス間）
+
+    ブロードキャストの通し番号はブローカー（ハブ）が振るので、全ワーカーで同じ番号になる。
+    番号にはブローカーの起動ごとのID（epoch）を添え、再起動で番号が振り直されたことをクライアントが見分けられるようにする。
+    """
+
+    # このプロセスがブローカー（ハブ）かどうか
+    is_primary = True
+    # 最後に配送したフレームの通し番号
+    last_seq = 0
+    # 通し番号の振り始めのID（プロセスの起動ごと）
+    epoch = uuid.uuid4().hex[:8]
+
+    def _started(self) -> bool:
+        """start前のpublishは配送先がないので、黙って捨てずにログを残す"""
+        if getattr(self, "_deliver", None) is None:
+            logger.warning("Broadcast backend is not started, dropping frame (call ConnectionManager.start() first)")
+            return False
+        return True
+
+    def _stamp(self, frame: Frame) -> Frame:
+        self.last_seq += 1
+        return frame.with_seq(self.last_seq, self.epoch)
+
+    async def start(self, deliver: DeliverFunc):
+        raise NotImplementedError
+
+    async def publish(self, frame: Frame):
+        raise NotImplementedError
+
+    async def stop(self):
+        pass
+
+
+class InProcessBackend(BroadcastBackend):
+    """単一プロセス用：publishしたフレームをそのまま自プロセスの接続に配る"""
+
+    def __init__(self):
+        self._deliver: Optional[DeliverFunc] = None
+
+    async def start(self, deliver: DeliverFunc):
+        self._deliver = deliver
+
+    async def publish(self, frame: Frame):
+        if self._started():
+            await self._deliver(self._stamp(frame))
+
+
+class UnixSocketBackend(BroadcastBackend):
+    """Unixソケットのローカルブローカー経由で複数ワーカーにフレームを配る
+
+    ロックファイルを取れたワーカーがハブ（ブローカー）になり、他のワーカーはハブに接続する。
+    各ワーカーのpublishはハブに送られ、ハブが全ワーカー（送信元を含む）に改行区切りで中継する。
+    1行は "チャンネル\\tJSON"（チャンネルなしは空文字）で、購読者への振り分けは各ワーカーが行う。
+    ハブが落ちると残りのワーカーの中から新しいハブが選ばれる。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self.is_primary = False
+        self._deliver: Optional[DeliverFunc] = None
+        self._lock_file = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._peers: Set[asyncio.StreamWriter] = set()
+        self._hub_writer: Optional[asyncio.StreamWriter] = None
+        self._ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, deliver: DeliverFunc):
+        self._deliver = deliver
+        self._task = asyncio.create_task(self._run())
+        # 役割（ハブ / ワーカー）が決まるまで少し待つ
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            logger.warning("Broadcast hub not reachable yet, delivering locally until connected")
+
+    async def publish(self, frame: Frame):
+        if not self._started():
+            return
+        if self.is_primary:
+            await self._fanout(frame)
+        elif self._hub_writer is not None:
+            # 自プロセスへの配送はハブからの折り返しで行う（全ワーカーで順序と通し番号を揃えるため）
+            self._hub_writer.write(frame.to_wire())
+        else:
+            # ハブ再選出中はせめて自プロセスの接続には届ける（通し番号なし = 再送対象外）
+            await self._deliver(frame)
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        if self._hub_writer:
+            self._hub_writer.close()
+        for peer in list(self._peers):
+            peer.close()
+        if self._server:
+            self._server.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        if self._lock_file:
+            self._lock_file.close()
+            self._lock_file = None
+        self.is_primary = False
+
+    async def _run(self):
+        while True:
+            if self._try_lock():
+                await self._serve()
+                return
+
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path, limit=MAX_LINE_BYTES)
+            except (FileNotFoundError, ConnectionRefusedError):
+                # ハブの起動待ち
+                await asyncio.sleep(0.2 + random.random() * 0.3)
+                continue
+
+            self._hub_writer = writer
+            self._ready.set()
+            logger.info(f"Connected to broadcast hub at {self.path}")
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    frame = Frame.from_wire(line)
+                    if frame.seq is not None:
+                        # ハブになったときにこの続きから（同じepochで）番号を振る
+                        self.last_seq = frame.seq
+                        self.epoch = frame.epoch
+                    await self._deliver(frame)
+            except Exception as e:
+                logger.error(f"Error reading from broadcast hub: {e}")
+            finally:
+                self._hub_writer = None
+                writer.close()
+            logger.warning("Lost connection to broadcast hub, re-electing")
+
+    def _try_lock(self) -> bool:
+        lock_file = open(self.lock_path, "a+")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    async def _serve(self):
+        # ロックを持っているので残っているソケットファイルは前のハブのもの
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self._server = await asyncio.start_unix_server(self._handle_peer, path=self.path, limit=MAX_LINE_BYTES)
+        self.is_primary = True
+        self._ready.set()
+        logger.info(f"Broadcast hub listening on {self.path} (pid {os.getpid()})")
+
+    async def _handle_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._peers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                await self._fanout(Frame.from_wire(line))
+        except Exception as e:
+            logger.error(f"Error reading from broadcast peer: {e}")
+        finally:
+            self._peers.discard(writer)
+            writer.close()
+
+    async def _fanout(self, frame: Frame):
+        frame = self._stamp(frame)
+        line = frame.to_wire()
+        for peer in list(self._peers):
+            if peer.transport.get_write_buffer_size() > MAX_PEER_BUFFER:
+                logger.warning("Broadcast peer is not reading, dropping it")
+                self._peers.discard(peer)
+                peer.close()
+                continue
+            peer.write(line)
+
+        await self._deliver(frame)
+
+
+def create_backend(kind: str, socket_path: str) -> BroadcastBackend:
+    """環境変数の値からバックエンドを作成"""
+    if kind == "unix":
+        return UnixSocketBackend(socket_path)
+    if kind != "inprocess":
+        logger.warning(f"Unknown broadcast backend '{kind}', falling back to inprocess")
+    return InProcessBackend()
@@ -0,0 +1,147 @@
+import logging
+import math
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+from zoneinfo import ZoneInfo
+
+logger = logging.getLogger(__name__)
+
+NEW_YORK = ZoneInfo("America/New_York")
+
+SESSION_OPEN = "open"
+SESSION_MAINTENANCE = "maintenance"
+SESSION_CLOSED = "closed"
+
+
+def cme_session_state(now: Optional[datetime] = None) -> str:
+    """CME Globex（NQ先物）の取引時間かどうか
+
+    日曜18:00〜金曜17:00（米国東部時間）、月〜木は17:00〜18:00がメンテナンス。祝日は考慮しない。
+    """
+    et = (now or datetime.now(timezone.utc)).astimezone(NEW_YORK)
+    weekday, hour = et.weekday(), et.hour
+    if weekday == 5:
+        return SESSION_CLOSED
+    if weekday == 6:
+        return SESSION_OPEN if hour >= 18 else SESSION_CLOSED
+    if hour == 17:
+        return SESSION_CLOSED if weekday == 4 else SESSION_MAINTENANCE
+    if weekday == 4 and hour > 17:
+        return SESSION_CLOSED
+    return SESSION_OPEN
+
+
+def next_session_open(now: Optional[datetime] = None) -> datetime:
+    """次に取引が始まる時刻（取引時間中ならnow）"""
+    now = now or datetime.now(timezone.utc)
+    if cme_session_state(now) == SESSION_OPEN:
+        return now
+    et = now.astimezone(NEW_YORK)
+    # 再開はいずれも東部時間18:00（メンテナンス明け・日曜の週明け）
+    candidate = et.replace(hour=18, minute=0, second=0, microsecond=0)
+    if candidate <= et:
+        candidate += timedelta(days=1)
+    while cme_session_state(candidate) != SESSION_OPEN:
+        candidate += timedelta(days=1)
+    return candidate
+
+
+class PollScheduler:
+    """Yahooへのポーリング間隔を決める
+
+    取引時間外は再開まで待ち、取引中は基準間隔を
+    直近の値動き（大きいほど短く）・同じバーが続いた回数（多いほど長く）・接続数（多いほど短く）で調整する。
+    """
+
+    def __init__(self, base_interval: float = 2.0, min_interval: float = 0.5,
+                 max_interval: float = 15.0, closed_interval: float = 300.0,
+                 volatility_reference: float = 1e-4, max_backoff_steps: int = 3):
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # 取引時間外でもこの間隔では確認する（祝日明けなどを取りこぼさないため）
+        self.closed_interval = closed_interval
+        # 1回のポーリングあたりの値動き（対数リターンの絶対値）の基準
+        self.volatility_reference = volatility_reference
+        self.max_backoff_steps = max_backoff_steps
+
+        self.volatility: Optional[float] = None
+        self.repeats = 0
+        self.last_price: Optional[float] = None
+
+        # 判断の記録（/api/metrics用）
+        self.polls = 0
+        self.changes = 0
+        self.session = SESSION_OPEN
+        self.interval = base_interval
+        self.reason = "initial"
+        self.clients = 0
+
+    def record(self, changed: bool, price: Optional[float] = None):
+        """ポーリング結果を取り込む（changed: 前回から何か変化したか）"""
+        self.polls += 1
+        if changed:
+            self.changes += 1
+            self.repeats = 0
+        else:
+            self.repeats += 1
+
+        if price is not None and price > 0:
+            if self.last_price:
+                move = abs(math.log(price / self.last_price))
+                # 指数移動平均（直近10回程度の値動き）
+                self.volatility = move if self.volatility is None else 0.8 * self.volatility + 0.2 * move
+            self.last_price = price
+
+    def next_interval(self, clients: int = 0, now: Optional[datetime] = None) -> float:
+        """次のポーリングまでの秒数"""
+        now = now or datetime.now(timezone.utc)
+        self.clients = clients
+        self.session = cme_session_state(now)
+
+        if self.session != SESSION_OPEN:
+            until_open = (next_session_open(now) - now).total_seconds()
+            self.interval = max(min(until_open, self.closed_interval), self.min_interval)
+            self.reason = self.session
+            return self.interval
+
+        interval = self.base_interval
+        reasons = []
+
+        if self.volatility is not None:
+            # 値動きが基準の2倍なら半分の間隔、半分なら2倍の間隔
+            factor = min(max(self.volatility_reference / max(self.volatility, 1e-12), 0.5), 2.0)
+            interval *= factor
+            if factor < 1:
+                reasons.append("volatile")
+            elif factor > 1:
+                reasons.append("quiet")
+
+        if self.repeats:
+            # 同じバーが続くほど間隔を倍にしていく
+            interval *= 2 ** min(self.repeats, self.max_backoff_steps)
+            reasons.append(f"repeat x{self.repeats}")
+
+        if clients == 0:
+            interval *= 2
+            reasons.append("no clients")
+        elif clients > 1:
+            # 接続数10で0.75倍、100以上で0.5倍
+            interval *= max(1 - math.log10(clients) / 4, 0.5)
+            reasons.append(f"{clients} clients")
+
+        self.interval = min(max(interval, self.min_interval), self.max_interval)
+        self.reason = ", ".join(reasons) or "base"
+        return self.interval
+
+    def metrics(self) -> Dict:
+        return {
+            "session": self.session,
+            "interval": self.interval,
+            "reason": self.reason,
+            "clients": self.clients,
+            "volatility": self.volatility,
+            "repeats": self.repeats,
+            "polls": self.polls,
+            "changes": self.changes,
+        }
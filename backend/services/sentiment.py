@@ -1,64 +1,254 @@
+from sqlalchemy import case, func, select, update
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
 from models import Comment
+import numpy as np
 import re
 
+BUY = "buy"
+SELL = "sell"
+NEUTRAL = "neutral"
+LABELS = (BUY, SELL, NEUTRAL)
+
+
+class SentimentSeries:
+    """分ごとの buy / sell / neutral 件数（分の番号の上のFenwick木）
+
+    任意の期間の件数は、区切りの分の番号を二分探索して累積和を2回引くだけで求まる。
+    投稿・削除は O(log n) で木を更新する。新しい分は末尾に足し、既にある最後の分より前に
+    分が増えたとき（過去の時刻の投稿）だけ作り直す。
+    """
+
+    def __init__(self, resolution: int = 60):
+        self.resolution = resolution
+        # 分の開始時刻(UNIX秒) -> [buy, sell, neutral]
+        self.counts: Dict[int, List[int]] = {}
+        # 分の開始時刻（昇順、先頭のsize個が有効）と1始まりのFenwick木（末尾への追加のため余裕を持たせる）
+        self._size = 0
+        self._times = np.empty(0, dtype=np.int64)
+        self._tree = np.zeros((1, len(LABELS)), dtype=np.int64)
+
+    def _bucket(self, timestamp: int) -> int:
+        return timestamp // self.resolution * self.resolution
+
+    def load(self, rows: Iterable[Tuple[int, str]]):
+        """(timestamp(UNIX秒), ラベル) の列で置き換える"""
+        self.counts = {}
+        for timestamp, label in rows:
+            self.counts.setdefault(self._bucket(timestamp), [0, 0, 0])[LABELS.index(label)] += 1
+        self._rebuild()
+
+    def apply(self, timestamp: int, label: str, delta: int):
+        bucket = self._bucket(timestamp)
+        column = LABELS.index(label)
+        counts = self.counts.get(bucket)
+        if counts is None:
+            if delta <= 0:
+                return
+            counts = self.counts[bucket] = [0, 0, 0]
+            if self._size and bucket < self._times[self._size - 1]:
+                counts[column] = delta
+                self._rebuild()
+                return
+            self._append(bucket)
+        change = max(counts[column] + delta, 0) - counts[column]
+        if change:
+            counts[column] += change
+            self._add(self._index(bucket), column, change)
+
+    def _index(self, bucket: int) -> int:
+        if self._times[self._size - 1] == bucket:
+            return self._size - 1
+        return int(np.searchsorted(self._times[:self._size], bucket))
+
+    def _rebuild(self):
+        times = sorted(self.counts)
+        size = len(times)
+        values = np.array([self.counts[t] for t in times], dtype=np.int64).reshape(-1, len(LABELS))
+        prefix = np.vstack([np.zeros((1, len(LABELS)), dtype=np.int64), np.cumsum(values, axis=0)])
+        # tree[i] は (i - lowbit(i), i] の合計
+        index = np.arange(1, size + 1)
+        self._tree = np.zeros((size + 1, len(LABELS)), dtype=np.int64)
+        self._tree[1:] = prefix[index] - prefix[index & (index - 1)]
+        self._times = np.array(times, dtype=np.int64)
+        self._size = size
+
+    def _append(self, bucket: int):
+        size = self._size
+        if size == len(self._times):
+            capacity = max(size * 2, 1024)
+            times = np.empty(capacity, dtype=np.int64)
+            times[:size] = self._times[:size]
+            tree = np.zeros((capacity + 1, len(LABELS)), dtype=np.int64)
+            tree[:size + 1] = self._tree[:size + 1]
+            self._times, self._tree = times, tree
+        # 新しい分の件数は0なので、覆う範囲のうち既存の分の合計だけを持たせる
+        i = size + 1
+        self._tree[i] = self._prefix(np.array([size]))[0] - self._prefix(np.array([i & (i - 1)]))[0]
+        self._times[size] = bucket
+        self._size = size + 1
+
+    def _add(self, position: int, column: int, delta: int):
+        i = position + 1
+        while i <= self._size:
+            self._tree[i, column] += delta
+            i += i & -i
+
+    def _prefix(self, index: np.ndarray) -> np.ndarray:
+        """先頭からindex個の分の合計（indexの配列をまとめて求める）"""
+        index = np.array(index, dtype=np.int64)
+        total = np.zeros((len(index), len(LABELS)), dtype=np.int64)
+        while index.any():
+            total += self._tree[index]
+            index &= index - 1
+        return total
+
+    def between(self, edges: np.ndarray) -> np.ndarray:
+        """区切り時刻の配列（昇順）を受け取り、隣り合う区切りの間 [edges[i], edges[i+1]) の件数を返す
+
+        区切りは分単位に切り捨てる。戻り値の形は (len(edges) - 1, 3)。
+        """
+        edges = np.asarray(edges, dtype=np.int64) // self.resolution * self.resolution
+        cumulative = self._prefix(np.searchsorted(self._times[:self._size], edges, side="left"))
+        return np.diff(cumulative, axis=0)
+
+    def range_counts(self, start: int, end: int) -> Tuple[int, int, int]:
+        """start〜end（UNIX秒、両端の分を含む）の (buy, sell, neutral)"""
+        counts = self.between(np.array([start, end + self.resolution]))[0]
+        return int(counts[0]), int(counts[1]), int(counts[2])
+
 class SentimentAnalyzer:
     def __init__(self):
         self.buy_keywords = ["買い", "ロング", "IN", "上昇", "強気", "ブル"]
         self.sell_keywords = ["売り", "ショート", "利確", "下落", "弱気", "ベア"]
+        self.pattern = self._compile()
+        # 全期間の件数と分ごとの件数（load_countsの後は投稿・削除のたびにapplyで増減させる）
+        self.counts: Optional[Dict[str, int]] = None
+        self.series = SentimentSeries()
+
+    def _compile(self) -> "re.Pattern":
+        """全キーワードを1つの正規表現にまとめる（どちらのグループに一致したかでBUY/SELLを判定）"""
+        def alternatives(keywords):
+            parts = []
+            for keyword in sorted(keywords, key=len, reverse=True):
+                escaped = re.escape(keyword)
+                # 英字のキーワード（IN）は大文字小文字を区別して単語として一致させる
+                # （英文の "in" や "coin"・"inside" には一致しない）
+                if keyword.isascii():
+                    escaped = rf"(?<![A-Za-z])(?-i:{escaped})(?![A-Za-z])"
+                parts.append(escaped)
+            return "|".join(parts)
+
+        return re.compile(
+            f"(?P<{BUY}>{alternatives(self.buy_keywords)})|(?P<{SELL}>{alternatives(self.sell_keywords)})",
+            re.IGNORECASE
+        )
+
+    def classify(self, content: str) -> str:
+        """コメント1件を buy / sell / neutral に分類"""
+        found = set()
+        for match in self.pattern.finditer(content):
+            found.add(match.lastgroup)
+            if len(found) == 2:
+                break
+
+        if found == {BUY}:
+            return BUY
+        if found == {SELL}:
+            return SELL
+        # どちらも含まれるか、どちらも含まれない場合は中立
+        return NEUTRAL
+
+    def classify_many(self, contents: Iterable[str]) -> List[str]:
+        """まとめて分類（バックフィル用）"""
+        classify = self.classify
+        return [classify(content) for content in contents]
+
+    def backfill_labels(self, db: Session, batch_size: int = 1000) -> int:
+        """sentimentが未設定のコメントを分類して保存する（更新した件数を返す）"""
+        updated = 0
+        while True:
+            rows = db.execute(
+                select(Comment.id, Comment.content)
+                .where(Comment.sentiment.is_(None))
+                .order_by(Comment.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                return updated
+            labels = self.classify_many(row.content for row in rows)
+            db.execute(
+                update(Comment),
+                [{"id": row.id, "sentiment": label} for row, label in zip(rows, labels)]
+            )
+            db.commit()
+            updated += len(rows)
+
+    def load_counts(self, db: Session):
+        """保存済みのラベルから全期間と分ごとの件数を読み込む（起動時）"""
+        self.counts = self._count_labels(db)
+        rows = db.execute(select(Comment.timestamp, Comment.sentiment).execution_options(yield_per=1000))
+        self.series.load((int(timestamp.timestamp()), label or NEUTRAL) for timestamp, label in rows)
+
+    def _count_labels(self, db: Session, *conditions) -> Dict[str, int]:
+        """ラベルごとの件数（SQL側で1行に集計する。未分類のものは中立に数える）
+
+        COUNT(*) FILTER はSQLiteの古い版で使えないので、どちらでも動く SUM(CASE ...) にしている。
+        """
+        stmt = select(
+            func.count(),
+            func.coalesce(func.sum(case((Comment.sentiment == BUY, 1), else_=0)), 0),
+            func.coalesce(func.sum(case((Comment.sentiment == SELL, 1), else_=0)), 0),
+        ).where(*conditions)
+        total, buy, sell = db.execute(stmt).one()
+        return {BUY: int(buy), SELL: int(sell), NEUTRAL: int(total - buy - sell)}
+
+    def current(self) -> dict:
+        """読み込み済みの全期間の件数から計算（O(1)）"""
+        return self.summarize(self.counts[BUY], self.counts[SELL], self.counts[NEUTRAL])
+
+    def apply(self, label: str, delta: int, timestamp: Optional[int] = None) -> bool:
+        """投稿(+1)・削除(-1)を件数に反映する（timestampはコメントのUNIX秒）"""
+        if self.counts is None or label not in self.counts:
+            return False
+        self.counts[label] = max(self.counts[label] + delta, 0)
+        if timestamp is not None:
+            self.series.apply(int(timestamp), label, delta)
+        return True
         
     def analyze_recent_comments(self, db: Session, hours: int = 1) -> dict:
         """直近のコメントからセンチメントを分析"""
         # timezone-awareなdatetimeを使用
         since = datetime.now(timezone.utc) - timedelta(hours=hours)
-        comments = db.query(Comment).filter(Comment.timestamp >= since).all()
-        
-        return self._analyze_comments(comments)
+        counts = self._count_labels(db, Comment.timestamp >= since)
+        return self.summarize(counts[BUY], counts[SELL], counts[NEUTRAL])
     
     def analyze_all_comments(self, db: Session) -> dict:
-        """すべてのコメントからセンチメントを分析"""
-        comments = db.query(Comment).all()
-        return self._analyze_comments(comments)
+        """すべてのコメントからセンチメントを分析（件数を読み込み済みならDBに問い合わせない）"""
+        if self.counts is not None:
+            return self.current()
+        counts = self._count_labels(db)
+        return self.summarize(counts[BUY], counts[SELL], counts[NEUTRAL])
     
     def analyze_comments_in_range(self, db: Session, start: datetime, end: datetime) -> dict:
-        """指定された期間のコメントからセンチメントを分析"""
-        comments = db.query(Comment).filter(
-            Comment.timestamp >= start,
-            Comment.timestamp <= end
-        ).all()
-        return self._analyze_comments(comments)
-
-    def _analyze_comments(self, comments) -> dict:
-        """コメントリストからセンチメントを分析"""
-        buy_count = 0
-        sell_count = 0
-        neutral_count = 0
-        
-        for comment in comments:
-            content = comment.content.lower()
-            
-            # BUYキーワードチェック
-            has_buy = any(keyword in content for keyword in self.buy_keywords)
-            # SELLキーワードチェック
-            has_sell = any(keyword in content for keyword in self.sell_keywords)
-            
-            if has_buy and not has_sell:
-                buy_count += 1
-            elif has_sell and not has_buy:
-                sell_count += 1
-            else:
-                # どちらも含まれるか、どちらも含まれない場合は中立
-                neutral_count += 1
-        
+        """指定された期間のコメントからセンチメントを分析（件数を読み込み済みなら分単位の累積和から）"""
+        if self.counts is not None:
+            return self.summarize(*self.series.range_counts(int(start.timestamp()), int(end.timestamp())))
+        counts = self._count_labels(db, Comment.timestamp >= start, Comment.timestamp <= end)
+        return self.summarize(counts[BUY], counts[SELL], counts[NEUTRAL])
+
+    def summarize(self, buy_count: int, sell_count: int, neutral_count: int) -> dict:
+        """件数から買い・売りの割合を計算"""
         total = buy_count + sell_count
+        total_comments = buy_count + sell_count + neutral_count
         
         if total == 0:
             # センチメントが判定できない場合は50:50
             return {
                 "buy_percentage": 50,
                 "sell_percentage": 50,
-                "total_comments": len(comments),
+                "total_comments": total_comments,
                 "buy_count": buy_count,
                 "sell_count": sell_count,
                 "neutral_count": neutral_count
@@ -67,8 +257,8 @@ class SentimentAnalyzer:
         return {
             "buy_percentage": round((buy_count / total) * 100),
             "sell_percentage": round((sell_count / total) * 100),
-            "total_comments": len(comments),
+            "total_comments": total_comments,
             "buy_count": buy_count,
             "sell_count": sell_count,
             "neutral_count": neutral_count
-        }
\ No newline at end of file
+        }
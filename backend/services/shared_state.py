@@ -0,0 +1,267 @@
+import asyncio
+import fcntl
+import glob
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+from urllib.parse import quote
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from services.serialization import dumps_bytes, loads
+
+logger = logging.getLogger(__name__)
+
+# generation(u64, 書き込み中は奇数) + payload長(u64)
+HEADER = struct.Struct("<QQ")
+
+
+def default_shared_dir() -> str:
+    """共有メモリ用のディレクトリ（/dev/shm があればRAM上に置く）"""
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class LeaderLock:
+    """ファイルロックによるリーダー選出（プロセスが落ちるとロックは自動で解放される）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._file is not None
+
+    def try_acquire(self) -> bool:
+        if self._file is not None:
+            return True
+        lock_file = open(self.path, "a+")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        return True
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    async def wait_for_leadership(self, on_elected: Callable[[], Awaitable[None]], retry_interval: float = 5.0):
+        """リーダーになれるまで定期的にロックを試し、なれたらon_electedを呼ぶ"""
+        while not self.try_acquire():
+            await asyncio.sleep(retry_interval)
+        logger.info(f"Acquired leader lock {self.path} (pid {os.getpid()})")
+        await on_elected()
+
+
+class SharedSegment:
+    """mmapしたファイル上の単一書き込み・複数読み出しのバイト列（seqlockで一貫性を保つ）"""
+
+    def __init__(self, path: str, initial_size: int = 1 << 20):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < HEADER.size:
+            os.ftruncate(self._fd, initial_size)
+        self._map = mmap.mmap(self._fd, os.fstat(self._fd).st_size)
+
+    def _remap(self, size: int):
+        self._map.close()
+        self._map = mmap.mmap(self._fd, size)
+
+    def write(self, payload: bytes):
+        needed = HEADER.size + len(payload)
+        if needed > len(self._map):
+            # 足りなければファイルを伸ばす（読み出し側は長さを見て自分でマップし直す）
+            new_size = max(needed, len(self._map) * 2)
+            os.ftruncate(self._fd, new_size)
+            self._remap(new_size)
+
+        generation, length = HEADER.unpack_from(self._map, 0)
+        if generation & 1:
+            # 前の書き込みが途中で落ちた場合
+            generation += 1
+        HEADER.pack_into(self._map, 0, generation + 1, length)
+        self._map[HEADER.size:needed] = payload
+        HEADER.pack_into(self._map, 0, generation + 2, len(payload))
+
+    def generation(self) -> int:
+        return HEADER.unpack_from(self._map, 0)[0]
+
+    def read(self, attempts: int = 12) -> Optional[Tuple[int, Optional[bytes]]]:
+        """(generation, payload) を返す。まだ何も書かれていなければpayloadはNone
+
+        書き込み中は待ち時間を倍にしながら読み直し、それでも一貫した内容が読めなければNoneを返す
+        （呼び出し側は共有メモリになかったものとして扱う）。
+        """
+        delay = 0.00005
+        for _ in range(attempts):
+            generation, length = HEADER.unpack_from(self._map, 0)
+            if not generation & 1:
+                if length == 0:
+                    return generation, None
+                if HEADER.size + length > len(self._map):
+                    self._remap(os.fstat(self._fd).st_size)
+                    continue
+                payload = self._map[HEADER.size:HEADER.size + length]
+                if HEADER.unpack_from(self._map, 0)[0] == generation:
+                    return generation, payload
+            time.sleep(delay)
+            delay = min(delay * 2, 0.002)
+        logger.warning(f"Could not read consistent data from {self.path}, treating it as missing")
+        return None
+
+
+class SharedMarketState:
+    """リーダーが取得した最新バーと履歴キャッシュをワーカー間で共有する"""
+
+    def __init__(self, directory: Optional[str] = None, prefix: str = "nasdaq100"):
+        directory = directory or default_shared_dir()
+        self.directory = directory
+        self.prefix = prefix
+        self.latest_segment = SharedSegment(os.path.join(directory, f"{prefix}-latest.seg"), 64 * 1024)
+        # 履歴キャッシュはキーごとに別のセグメントにする（1回の書き込み・読み出しを小さく保つ）
+        self._historical_segments: Dict[str, SharedSegment] = {}
+        # デコード結果をgenerationごとにキャッシュ
+        self._decoded: Dict[str, Tuple[int, object]] = {}
+        # ワーカーごとの「接続が見ている銘柄」（自分の分は書き込み用に持つ）
+        self.demand_segment: Optional[SharedSegment] = None
+        # フォロワーがリーダーに取得を頼んでいる履歴（共有メモリになかったもの）
+        self.request_segment: Optional[SharedSegment] = None
+        self._worker_segments: Dict[str, SharedSegment] = {}
+
+    def _read(self, name: str, segment: SharedSegment):
+        generation = segment.generation()
+        cached = self._decoded.get(name)
+        if cached and cached[0] == generation:
+            return cached[1]
+        result = segment.read()
+        if result is None:
+            return None
+        generation, payload = result
+        value = loads(payload) if payload else None
+        self._decoded[name] = (generation, value)
+        return value
+
+    def publish_latest(self, data: Dict[str, Dict]):
+        """{symbol: 最新バー} を書き込む"""
+        self.latest_segment.write(dumps_bytes(data))
+
+    def read_latest(self) -> Optional[Dict[str, Dict]]:
+        return self._read("latest", self.latest_segment)
+
+    def _worker_path(self, kind: str, pid) -> str:
+        return os.path.join(self.directory, f"{self.prefix}-{kind}-{pid}.seg")
+
+    def publish_demand(self, symbols: List[str], clients: int = 0, channels: List[str] = ()):
+        """このワーカーの接続が見ている銘柄・時間足ごとのチャンネルと接続数を書き込む
+
+        リーダーがポーリング対象・配信するチャンネル・ポーリング間隔を決めるのに使う。
+        """
+        if self.demand_segment is None:
+            self.demand_segment = SharedSegment(self._worker_path("demand", os.getpid()), 4096)
+        self.demand_segment.write(dumps_bytes({
+            "symbols": sorted(symbols), "clients": clients, "channels": sorted(channels)
+        }))
+
+    def publish_requests(self, requests: List[Tuple[str, str]]):
+        """このワーカーがリーダーに取得を頼んでいる履歴の (symbol, interval) を書き込む"""
+        if self.request_segment is None:
+            self.request_segment = SharedSegment(self._worker_path("requests", os.getpid()), 4096)
+        self.request_segment.write(dumps_bytes(sorted(requests)))
+
+    def read_requests(self) -> Set[Tuple[str, str]]:
+        """全ワーカーがリーダーに取得を頼んでいる履歴の (symbol, interval)"""
+        return {tuple(request) for entry in self._read_worker_entries("requests") for request in entry}
+
+    def withdraw_demand(self):
+        """このワーカーの需要・取得依頼を取り下げる（終了時）"""
+        for segment in (self.demand_segment, self.request_segment):
+            if segment is not None:
+                try:
+                    os.unlink(segment.path)
+                except FileNotFoundError:
+                    pass
+        self.demand_segment = None
+        self.request_segment = None
+
+    def _read_demand_entries(self) -> List[Dict]:
+        return self._read_worker_entries("demand")
+
+    def _read_worker_entries(self, kind: str) -> List:
+        # 終了したワーカーの分は削除する
+        entries = []
+        for path in glob.glob(self._worker_path(kind, "*")):
+            pid = int(path.rsplit("-", 1)[1].split(".", 1)[0])
+            if not _pid_alive(pid):
+                self._worker_segments.pop(path, None)
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            segment = self._worker_segments.get(path)
+            if segment is None:
+                segment = self._worker_segments[path] = SharedSegment(path, 4096)
+            result = segment.read()
+            if result and result[1]:
+                entries.append(loads(result[1]))
+        return entries
+
+    def read_demand(self) -> Set[str]:
+        """全ワーカーの接続が見ている銘柄"""
+        symbols: Set[str] = set()
+        for entry in self._read_demand_entries():
+            symbols.update(entry["symbols"])
+        return symbols
+
+    def read_demand_channels(self) -> Set[str]:
+        """全ワーカーの接続が購読している時間足ごとのチャンネル"""
+        channels: Set[str] = set()
+        for entry in self._read_demand_entries():
+            channels.update(entry.get("channels", ()))
+        return channels
+
+    def read_client_count(self) -> int:
+        """全ワーカーの接続数の合計"""
+        return sum(entry["clients"] for entry in self._read_demand_entries())
+
+    def _historical_segment(self, cache_key: str, create: bool) -> Optional[SharedSegment]:
+        segment = self._historical_segments.get(cache_key)
+        if segment is None:
+            # キーの記号（^ や = など）はファイル名に使える形に可逆に変換する
+            path = os.path.join(self.directory, f"{self.prefix}-historical-{quote(cache_key, safe='')}.seg")
+            if not create and not os.path.exists(path):
+                return None
+            segment = self._historical_segments[cache_key] = SharedSegment(path, 64 * 1024)
+        return segment
+
+    def publish_historical(self, cache_key: str, data: object, cached_time: float):
+        """1つのキャッシュキーの (data, cached_time) を書き込む"""
+        self._historical_segment(cache_key, create=True).write(dumps_bytes([data, cached_time]))
+
+    def read_historical(self, cache_key: str) -> Optional[Tuple[object, float]]:
+        segment = self._historical_segment(cache_key, create=False)
+        if segment is None:
+            return None
+        entry = self._read(f"historical:{cache_key}", segment)
+        if not entry:
+            return None
+        data, cached_time = entry
+        return data, cached_time
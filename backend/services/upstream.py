@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Optional
+
+from curl_cffi import requests
+
+from services.bar_series import BarSeries
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamError(Exception):
+    """Yahoo Financeからデータを取得できなかった"""
+
+
+class ClientError(UpstreamError):
+    """銘柄が存在しないなど、リトライしても変わらない失敗（HTTP 4xx）"""
+
+
+class CircuitOpenError(UpstreamError):
+    """サーキットブレーカーが開いているので問い合わせを行わなかった"""
+
+
+class CircuitBreaker:
+    """連続して失敗したら一定時間問い合わせを止める（closed -> open -> half_open -> closed）"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        # half_openで試しに通した問い合わせがまだ終わっていないか
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        # half_openでは試しに1つだけ通し（結果が出るまで他は止める）、結果で閉じるか開き直すかを決める
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "open" or self.probing:
+            return False
+        self.probing = True
+        return True
+
+    def release(self):
+        """allowで通した問い合わせが終わった（成功・失敗のどちらにも数えない結果でも呼ぶ）"""
+        self.probing = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or (self.opened_at is None and self.failures >= self.failure_threshold):
+            logger.warning(f"Upstream circuit opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+
+class YahooChartClient:
+    """Yahoo chart APIの非同期クライアント（接続プール・タイムアウト・リトライ・サーキットブレーカー）"""
+
+    BASE_URL = "https://query1.finance.yahoo.com/v8/finance/chart/"
+
+    HEADERS = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36",
+        "Accept": "application/json",
+        "Accept-Language": "en-US,en;q=0.9",
+        "Accept-Encoding": "gzip, deflate, br",
+        "Cache-Control": "no-cache",
+        "Pragma": "no-cache",
+        "Sec-Fetch-Dest": "empty",
+        "Sec-Fetch-Mode": "cors",
+        "Sec-Fetch-Site": "same-site"
+    }
+
+    def __init__(self, timeout: float = 10.0, retries: int = 3, backoff_base: float = 0.5,
+                 backoff_max: float = 8.0, max_clients: int = 10, breaker: Optional[CircuitBreaker] = None):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_clients = max_clients
+        self.breaker = breaker or CircuitBreaker()
+        self._session: Optional[requests.AsyncSession] = None
+
+    @property
+    def session(self) -> requests.AsyncSession:
+        # イベントループ上で初めて使うときに作る
+        if self._session is None:
+            self._session = requests.AsyncSession(impersonate="chrome110", max_clients=self.max_clients)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def _backoff(self, attempt: int) -> float:
+        # full jitter: 0〜min(上限, base * 2^attempt) の一様乱数
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def fetch_chart(self, symbol: str, interval: str, period1: int, period2: int) -> BarSeries:
+        """[period1, period2] のバーを取得。失敗時はUpstreamErrorを送出"""
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"Circuit open, skipping request for {symbol} {interval}")
+        try:
+            return await self._fetch(symbol, interval, period1, period2)
+        finally:
+            self.breaker.release()
+
+    async def _fetch(self, symbol: str, interval: str, period1: int, period2: int) -> BarSeries:
+        params = {
+            "period1": period1,
+            "period2": period2,
+            "interval": interval,
+            "includePrePost": "true",
+            "events": "div%7Csplit%7Ccapitalgains",
+            "useYfid": "true",
+            "includeAdjustedClose": "true"
+        }
+
+        last_error: Optional[Exception] = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self._backoff(attempt - 1))
+            try:
+                response = await self.session.get(
+                    self.BASE_URL + symbol, params=params, headers=self.HEADERS, timeout=self.timeout
+                )
+            except Exception as e:
+                last_error = e
+                logger.warning(f"Yahoo request failed ({attempt + 1}/{self.retries + 1}): {e}")
+                continue
+
+            if response.status_code == 429 or response.status_code >= 500:
+                last_error = UpstreamError(f"HTTP {response.status_code}")
+                logger.warning(f"Yahoo returned HTTP {response.status_code} ({attempt + 1}/{self.retries + 1})")
+                continue
+            if response.status_code != 200:
+                # 銘柄が存在しないなどはリトライしても変わらない（上流の障害ではないが、成功にも数えない）
+                raise ClientError(f"Failed to fetch data: HTTP {response.status_code}")
+
+            try:
+                series = self._parse(response.json())
+            except Exception:
+                # 200でも中身が壊れていれば失敗に数える
+                self.breaker.record_failure()
+                raise
+            self.breaker.record_success()
+            return series
+
+        self.breaker.record_failure()
+        raise UpstreamError(f"Yahoo request for {symbol} {interval} failed: {last_error}")
+
+    def _parse(self, data: dict) -> BarSeries:
+        # データの解析
+        if 'chart' not in data or not data['chart'].get('result'):
+            raise UpstreamError("Invalid response structure from Yahoo Finance")
+
+        result = data['chart']['result'][0]
+        if 'timestamp' not in result:
+            # 取引がない期間はtimestampが返らない
+            return BarSeries.empty()
+
+        return BarSeries.from_yahoo(result['timestamp'], result['indicators']['quote'][0])
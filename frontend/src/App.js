@@ -12,6 +12,10 @@ import axios from 'axios';
 import './styles/App.css';
 
 const API_URL = process.env.REACT_APP_API_URL || 'http://localhost:8000';
+// ^NDX のチャートはNQ先物のリアルタイム更新で動かす（通し番号はチャンネルごと）
+const LIVE_SYMBOL = 'NQ=F';
+const COMMENTS_CHANNEL = `comments:${LIVE_SYMBOL}`;
+const marketChannel = (timeFrame) => `market:${LIVE_SYMBOL}:${timeFrame}`;
 
 // LocalStorageのキー
 const TIMEFRAME_STORAGE_KEY = 'nasdaq100_selected_timeframe';
@@ -47,15 +51,6 @@ function generateDemoData(timeFrame) {
   return data;
 }
 
-function generateDemoComments() {
-  const now = Math.floor(Date.now() / 1000);
-  return [
-    { id: 1, timestamp: now - 300, price: 23700.50, content: 'ナスダック強気！🚀', emotion_icon: '🚀' },
-    { id: 2, timestamp: now - 900, price: 23650.25, content: 'この辺で買い増し検討中', emotion_icon: '😊' },
-    { id: 3, timestamp: now - 1800, price: 23750.75, content: '利確しました。様子見', emotion_icon: '😎' }
-  ];
-}
-
 function getStoredTimeFrame() {
   try {
     const stored = localStorage.getItem(TIMEFRAME_STORAGE_KEY);
@@ -78,7 +73,7 @@ function saveTimeFrame(timeFrame) {
 
 function App() {
   const [timeFrame, setTimeFrame] = useState(getStoredTimeFrame);
-  const [comments, setComments] = useState([]);
+  const [commentBuckets, setCommentBuckets] = useState([]);
   const [sentiment, setSentiment] = useState({ buy_percentage: 50, sell_percentage: 50 });
   const [showPostModal, setShowPostModal] = useState(false);
   const [chartData, setChartData] = useState([]);
@@ -94,6 +89,10 @@ function App() {
 
   const timeFrameRef = useRef(timeFrame);
   useEffect(() => { timeFrameRef.current = timeFrame; }, [timeFrame]);
+  const visibleRangeRef = useRef(visibleRange);
+  useEffect(() => { visibleRangeRef.current = visibleRange; }, [visibleRange]);
+  // market_updateのチャンネルごとの { epoch, seq }（取りこぼし検知用）
+  const marketSeqRef = useRef({});
 
   // Check Auth Status on Load
   useEffect(() => {
@@ -133,20 +132,26 @@ function App() {
     }
   }, [timeFrame]);
 
+  // コメントはサーバーでローソク足ごとにまとめたもの（1本につき1件）を取得する
   const loadComments = useCallback(async () => {
     try {
-      const commentsRes = await axios.get(`${API_URL}/api/comments`);
-      if (commentsRes.data.comments) {
-        setComments(commentsRes.data.comments);
-      } else {
-        setComments([]);
-      }
+      const res = await axios.get(`${API_URL}/api/comments/buckets`, {
+        params: { symbol: '^NDX', interval: timeFrameRef.current }
+      });
+      setCommentBuckets(res.data.buckets || []);
     } catch (error) {
       console.error('Failed to load comments:', error);
-      setComments(generateDemoComments());
+      setCommentBuckets([]);
     }
   }, []);
 
+  // 投稿・削除が続いても取り直しは1回にまとめる
+  const reloadCommentsTimerRef = useRef(null);
+  const scheduleReloadComments = useCallback(() => {
+    if (reloadCommentsTimerRef.current) clearTimeout(reloadCommentsTimerRef.current);
+    reloadCommentsTimerRef.current = setTimeout(loadComments, 300);
+  }, [loadComments]);
+
   const loadSentiment = useCallback(async (start = null, end = null) => {
     try {
       let url = `${API_URL}/api/sentiment`;
@@ -177,32 +182,18 @@ function App() {
     }
   }, []);
 
-  const updateChartWithNewPrice = useCallback((newPrice) => {
+  // サーバーが組み立てた形成中の足で最後の足を置き換える（新しい足なら追加）
+  const applyLiveCandle = useCallback((candle) => {
     setChartData(prevData => {
       if (!prevData || prevData.length === 0) return prevData;
       const lastCandle = prevData[prevData.length - 1];
-      const now = Math.floor(Date.now() / 1000);
-      const intervals = { '1m': 60, '3m': 180, '5m': 300, '15m': 900, '1H': 3600, '4H': 14400, '1D': 86400, '1W': 604800 };
-      const interval = intervals[timeFrameRef.current] || 900;
-      
-      if (now - lastCandle.time >= interval) {
-        const newCandle = {
-          time: lastCandle.time + interval,
-          open: lastCandle.close,
-          high: Math.max(lastCandle.close, newPrice),
-          low: Math.min(lastCandle.close, newPrice),
-          close: newPrice,
-          volume: Math.floor(Math.random() * 1000000)
-        };
-        return [...prevData.slice(-99), newCandle];
-      } else {
-        const updatedData = [...prevData];
-        const last = updatedData[updatedData.length - 1];
-        last.high = Math.max(last.high, newPrice);
-        last.low = Math.min(last.low, newPrice);
-        last.close = newPrice;
-        return updatedData;
+      if (candle.time === lastCandle.time) {
+        return [...prevData.slice(0, -1), candle];
       }
+      if (candle.time > lastCandle.time) {
+        return [...prevData, candle];
+      }
+      return prevData;
     });
   }, []);
 
@@ -213,32 +204,58 @@ function App() {
     const ws = new WebSocketService(`${wsUrl}/ws`);
     setWsService(ws);
     
-    ws.on('new_comment', (data) => {
-      setComments(prev => {
-        const exists = prev.find(c => c.id === data.id);
-        if (exists) return prev;
-        return [data, ...prev];
-      });
+    ws.on('new_comment', () => {
+      scheduleReloadComments();
     });
     
-    ws.on('comment_saved', (data) => {
-      setComments(prev => {
-        const exists = prev.find(c => c.id === data.id);
-        if (!exists) return [data, ...prev];
-        return prev;
-      });
-      loadSentiment();
+    ws.on('comment_saved', () => {
+      scheduleReloadComments();
     });
 
-    ws.on('delete_comment', (data) => {
-      setComments(prev => prev.filter(c => c.id !== data.id));
-      loadSentiment();
+    ws.on('delete_comment', () => {
+      scheduleReloadComments();
+    });
+
+    // 投稿・削除のたびにサーバーが全期間のセンチメントを送ってくる（表示範囲を絞っているときは取り直す）
+    ws.on('sentiment_update', (data) => {
+      const { start, end } = visibleRangeRef.current;
+      if (start && end) {
+        loadSentiment(start, end);
+      } else if (data) {
+        setSentiment(data);
+      }
     });
     
     ws.on('error', (data) => console.error('WebSocket error:', data));
+
+    // 切断が長く再送できなかった場合は全体を取り直す
+    ws.on('resync', () => {
+      marketSeqRef.current = {};
+      loadChartData();
+      loadComments();
+      loadSentiment();
+    });
     
-    ws.on('market_update', (data) => {
-      if (data && data.price) updateChartWithNewPrice(data.price);
+    ws.on('market_update', (data, message) => {
+      if (!data || data.symbol !== LIVE_SYMBOL) return;
+      // market_updateは変化したフィールドだけの差分。番号が飛んだらチャートを取り直す
+      const channel = (message && message.channel) || `market:${LIVE_SYMBOL}`;
+      if (data.seq) {
+        const last = marketSeqRef.current[channel];
+        // epochが変わったら（再起動・リーダー交代など）番号は振り直されているので比べない
+        const lastSeq = last && last.epoch === data.epoch ? last.seq : undefined;
+        // 再接続時の再送と購読時のスナップショットが重なった場合の古い差分は捨てる
+        if (lastSeq !== undefined && data.seq <= lastSeq) return;
+        // 送信キューでまとめられた差分は seq_from〜seq を覆っているので、その先頭で取りこぼしを判定する
+        const firstSeq = data.seq_from || data.seq;
+        if (lastSeq !== undefined && firstSeq > lastSeq + 1) {
+          console.warn(`market_update gap on ${channel}: ${lastSeq} -> ${data.seq}`);
+          loadChartData();
+        }
+        marketSeqRef.current[channel] = { epoch: data.epoch, seq: data.seq };
+      }
+      const candle = data.bars && data.bars[timeFrameRef.current];
+      if (candle) applyLiveCandle(candle);
     });
 
     const currentTimeFrame = getStoredTimeFrame();
@@ -255,14 +272,24 @@ function App() {
       clearInterval(intervalId);
       ws.close();
     };
-  }, [currentUser, loadChartData, loadComments, loadSentiment, updateChartWithNewPrice]);
+  }, [currentUser, loadChartData, loadComments, scheduleReloadComments, loadSentiment, applyLiveCandle]);
+
+  // 表示中の時間足のチャンネルとコメントだけを購読する
+  useEffect(() => {
+    if (!wsService) return;
+    const channel = marketChannel(timeFrame);
+    wsService.subscribe(channel);
+    wsService.subscribe(COMMENTS_CHANNEL);
+    return () => wsService.unsubscribe(channel);
+  }, [wsService, timeFrame]);
 
   useEffect(() => {
     if (!currentUser) return;
     loadChartData(timeFrame);
     setVisibleRange({ start: null, end: null });
+    loadComments();
     loadSentiment();
-  }, [timeFrame, currentUser, loadChartData, loadSentiment]);
+  }, [timeFrame, currentUser, loadChartData, loadComments, loadSentiment]);
 
   const handleCandleClick = useCallback((candleData) => {
     setSelectedCandle(candleData);
@@ -327,7 +354,7 @@ function App() {
       <main className="app-main">
         <Chart 
           data={chartData}
-          comments={comments}
+          commentBuckets={commentBuckets}
           currentUser={currentUser}
           onDeleteComment={handleDeleteComment}
           onCandleClick={handleCandleClick}
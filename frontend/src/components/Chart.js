@@ -1,28 +1,10 @@
 import React, { useMemo, useCallback, useRef } from 'react';
 import Plot from 'react-plotly.js';
 
-const Chart = ({ data, comments, currentUser, onAnnotationClick, onDeleteComment, onCandleClick, onVisibleRangeChange }) => {
+const Chart = ({ data, commentBuckets, currentUser, onAnnotationClick, onDeleteComment, onCandleClick, onVisibleRangeChange }) => {
   const chartRef = useRef(null);
   const debounceTimerRef = useRef(null);
 
-  // コメントをタイムスタンプでグループ化
-  const groupedComments = useMemo(() => {
-    if (!comments) return {};
-    const groups = {};
-    comments.forEach(c => {
-        let ts = c.timestamp;
-        if (typeof ts === 'string') {
-          ts = new Date(ts).getTime() / 1000;
-        } else if (ts > 1000000000000) {
-          ts = ts / 1000;
-        }
-
-        if (!groups[ts]) groups[ts] = [];
-        groups[ts].push(c);
-    });
-    return groups;
-  }, [comments]);
-
   // チャートデータの変換
   const chartData = useMemo(() => {
     if (!data || data.length === 0) return [];
@@ -40,43 +22,23 @@ const Chart = ({ data, comments, currentUser, onAnnotationClick, onDeleteComment
     }];
   }, [data]);
 
-  // コメントをアノテーションに変換
+  // ローソク足ごとにまとめられたコメント（サーバー側で集計済み、時刻順）をアノテーションに変換
   const annotations = useMemo(() => {
-    if (!groupedComments) return [];
-    
-    // データ（ローソク足）を時間で検索できるようにマップ化
-    const dataMap = new Map();
-    if (data && data.length > 0) {
-      data.forEach(d => {
-        dataMap.set(d.time, d);
-      });
-    }
-
-    const result = [];
-    Object.keys(groupedComments).forEach(tsKey => {
-        const ts = parseFloat(tsKey);
-        const group = groupedComments[tsKey];
-        const candle = dataMap.get(ts);
+    if (!commentBuckets) return [];
 
-        // 複数コメントがある場合は、そのグループ内の最高価格を採用するか、ローソク足の高値を使う
-        // ここではローソク足の高値を優先し、なければグループ内の最高価格
-        let yPos;
-        if (candle) {
-            yPos = candle.high;
-        } else {
-            yPos = Math.max(...group.map(c => parseFloat(c.price)));
-        }
+    return commentBuckets.map(bucket => {
+        const x = new Date(bucket.time * 1000);
 
-        if (group.length > 1) {
+        if (bucket.count > 1) {
             // 複数コメント：件数表示
-            const hasMyComment = currentUser && group.some(c => c.user_id === currentUser.id);
-            const contentPreview = group.map(c => c.content).join('\n');
-
-            result.push({
-                x: new Date(ts * 1000),
-                y: yPos,
-                text: `💬 ${group.length}` + (hasMyComment ? ' ●' : ''),
-                hovertext: contentPreview,
+            const hasMyComment = currentUser && bucket.user_ids.includes(currentUser.id);
+            const more = bucket.count - bucket.previews.length;
+
+            return {
+                x,
+                y: bucket.high,
+                text: `💬 ${bucket.count}` + (hasMyComment ? ' ●' : ''),
+                hovertext: bucket.previews.join('\n') + (more > 0 ? `\n…他${more}件` : ''),
                 showarrow: true,
                 arrowhead: 1,
                 arrowsize: 1,
@@ -95,41 +57,39 @@ const Chart = ({ data, comments, currentUser, onAnnotationClick, onDeleteComment
                 },
                 captureevents: true,
                 // Custom data to identify group on click
-                name: `group_${ts}`
-            });
-        } else {
-            // 単一コメント：従来の表示
-            const comment = group[0];
-            const isOwner = currentUser && currentUser.id === comment.user_id;
-
-            result.push({
-                x: new Date(ts * 1000),
-                y: yPos,
-                text: (comment.emotion_icon || '💬') + (isOwner ? ' 🗑️' : ''),
-                hovertext: comment.content,
-                showarrow: true,
-                arrowhead: 1,
-                arrowsize: 1,
-                arrowwidth: 2,
-                arrowcolor: 'rgba(94, 234, 212, 0.8)',
-                ax: 0,
-                ay: -30,
-                bgcolor: isOwner ? 'rgba(255, 235, 59, 0.5)' : 'rgba(94, 234, 212, 0.25)',
-                bordercolor: 'rgba(94, 234, 212, 0.6)',
-                borderwidth: 1,
-                borderpad: 4,
-                font: {
-                  size: 16,
-                  color: '#1f2937'
-                },
-                captureevents: true,
-                name: `single_${comment.id}`
-            });
+                name: `group_${bucket.time}`
+            };
         }
-    });
 
-    return result;
-  }, [groupedComments, data, currentUser]);
+        // 単一コメント：従来の表示
+        const comment = bucket.comment;
+        const isOwner = currentUser && currentUser.id === comment.user_id;
+
+        return {
+            x,
+            y: bucket.high,
+            text: (comment.emotion_icon || '💬') + (isOwner ? ' 🗑️' : ''),
+            hovertext: comment.content,
+            showarrow: true,
+            arrowhead: 1,
+            arrowsize: 1,
+            arrowwidth: 2,
+            arrowcolor: 'rgba(94, 234, 212, 0.8)',
+            ax: 0,
+            ay: -30,
+            bgcolor: isOwner ? 'rgba(255, 235, 59, 0.5)' : 'rgba(94, 234, 212, 0.25)',
+            bordercolor: 'rgba(94, 234, 212, 0.6)',
+            borderwidth: 1,
+            borderpad: 4,
+            font: {
+              size: 16,
+              color: '#1f2937'
+            },
+            captureevents: true,
+            name: `single_${comment.id}`
+        };
+    });
+  }, [commentBuckets, currentUser]);
 
   // レイアウト変更（ズーム・パン）ハンドラー
   const handleRelayout = useCallback((event) => {
@@ -186,37 +146,20 @@ const Chart = ({ data, comments, currentUser, onAnnotationClick, onDeleteComment
   };
 
   const handleAnnotationClick = useCallback((event) => {
-    // indexはこの配列(annotations)内のインデックス
-    const index = event.index;
-    // annotations再計算と同じ順序でキーを取り出す必要があるため、少し脆弱性がある。
-    // useMemoの順序依存を避けるため、Object.keysの順序（数値キーなら昇順）に依存するが、
-    // ここではannotations配列そのものに対応するデータを持たせるのが難しい（Plotlyの制限）。
-    // 代わりに、タイムスタンプ順にソートして生成するようにして一貫性を持たせる。
-
-    const sortedKeys = Object.keys(groupedComments).sort((a,b) => parseFloat(a) - parseFloat(b));
-    const tsKey = sortedKeys[index];
-    const group = groupedComments[tsKey];
-
-    if (group) {
-        // グループが1件だけの場合で、かつ従来の削除フローを使いたい場合
-        if (group.length === 1 && onDeleteComment) {
-             const comment = group[0];
-             const isOwner = currentUser && currentUser.id === comment.user_id;
-             // 削除ボタンをクリックしたかどうかの判定はPlotlyでは難しいので、
-             // 単一コメントの場合は従来通り確認ダイアログ -> 削除、またはモーダル表示に統一する。
-             // ここでは「一覧で見れる」要望を満たすため、単一でもモーダル表示(onAnnotationClick呼び出し)に統一する。
-             if (onAnnotationClick) {
-                 onAnnotationClick(group);
-             } else if (isOwner) {
-                 if (window.confirm('このコメントを削除しますか？')) {
-                    onDeleteComment(comment.id);
-                 }
-             }
-        } else if (onAnnotationClick) {
-            onAnnotationClick(group);
+    // indexはannotations配列内のインデックス（commentBucketsと同じ順序）
+    const bucket = commentBuckets && commentBuckets[event.index];
+    if (!bucket) return;
+
+    if (onAnnotationClick) {
+        onAnnotationClick(bucket);
+    } else if (bucket.count === 1 && onDeleteComment) {
+        const comment = bucket.comment;
+        const isOwner = currentUser && currentUser.id === comment.user_id;
+        if (isOwner && window.confirm('このコメントを削除しますか？')) {
+            onDeleteComment(comment.id);
         }
     }
-  }, [groupedComments, currentUser, onDeleteComment, onAnnotationClick]);
+  }, [commentBuckets, currentUser, onDeleteComment, onAnnotationClick]);
 
   return (
     <div className="chart-container" style={{ height: '600px', padding: '2rem' }}>
@@ -14,6 +14,9 @@ class WebSocketService {
     this.reconnectInterval = 5000;
     this.shouldReconnect = true;
     this.messageQueue = []; // 接続前のメッセージを保持
+    this.subscriptions = new Set(); // 購読中のチャンネル（再接続時に送り直す）
+    this.lastSeq = null; // 最後に受け取ったブロードキャストの通し番号（再接続時の再送要求に使う）
+    this.lastEpoch = null; // その番号を振ったサーバーの起動ID（再起動していたらresyncが届く）
     
     this.connect();
     WebSocketService.instance = this;
@@ -34,6 +37,12 @@ class WebSocketService {
       
       this.ws.onopen = () => {
         console.log('WebSocket connected');
+        // 新しい接続はどのチャンネルも購読していないので送り直す
+        this.subscriptions.forEach(channel => this.send({ type: 'subscribe', channel }));
+        // 切断中に取りこぼしたブロードキャストを送ってもらう（古すぎる場合はresyncが届く）
+        if (this.lastSeq !== null) {
+          this.send({ type: 'resume', since: this.lastSeq, epoch: this.lastEpoch });
+        }
         // キューに溜まったメッセージを送信
         while (this.messageQueue.length > 0) {
           const message = this.messageQueue.shift();
@@ -45,7 +54,14 @@ class WebSocketService {
         try {
           const data = JSON.parse(event.data);
           console.log('WebSocket message received:', data.type);
-          this.emit(data.type, data.data);
+          if (typeof data.seq === 'number') {
+            this.lastSeq = data.seq;
+            this.lastEpoch = data.epoch || null;
+          } else if (data.type === 'resync' && data.data) {
+            this.lastSeq = data.data.seq;
+            this.lastEpoch = data.data.epoch || null;
+          }
+          this.emit(data.type, data.data, data);
         } catch (error) {
           console.error('Failed to parse WebSocket message:', error);
         }
@@ -78,11 +94,11 @@ class WebSocketService {
     this.listeners[event] = this.listeners[event].filter(cb => cb !== callback);
   }
   
-  emit(event, data) {
+  emit(event, data, message) {
     if (!this.listeners[event]) return;
     this.listeners[event].forEach(callback => {
       try {
-        callback(data);
+        callback(data, message);
       } catch (error) {
         console.error(`Error in ${event} listener:`, error);
       }
@@ -100,6 +116,22 @@ class WebSocketService {
     }
   }
   
+  // チャンネル（market:NQ=F:5m / comments:NQ=F など）の購読
+  subscribe(channel) {
+    if (this.subscriptions.has(channel)) return;
+    this.subscriptions.add(channel);
+    if (this.ws && this.ws.readyState === WebSocket.OPEN) {
+      this.send({ type: 'subscribe', channel });
+    }
+  }
+
+  unsubscribe(channel) {
+    if (!this.subscriptions.delete(channel)) return;
+    if (this.ws && this.ws.readyState === WebSocket.OPEN) {
+      this.send({ type: 'unsubscribe', channel });
+    }
+  }
+  
   close() {
     this.shouldReconnect = false;
     if (this.ws) {